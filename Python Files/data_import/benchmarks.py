@@ -0,0 +1,248 @@
+import os
+import sys
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(parentdir)
+
+import contextlib
+import io
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from sqlalchemy import Integer, Float, Date, DateTime
+from data_import.main import (
+	model_map,
+	date_fields,
+	normalize_column_name,
+	convert_to_datetime,
+	prepare_records,
+	load_import_csv,
+	apply_import_plan
+)
+from data_import.models import Charge
+from data_import.import_related_data import prepare_charge_tabs
+from data_recruitment.csv_scraper import downloads_dir
+
+
+# Row preparation as it was done before prepare_records (row by row with iterrows). Kept to compare against
+def legacy_prepare_records(df, datetime_fields=()):
+	records = []
+	for _, row in df.iterrows():
+		row_data = row.to_dict()
+		for field in datetime_fields:
+			if field in row_data:
+				row_data[field] = convert_to_datetime(row_data[field])
+		for key, value in row_data.items():
+			if pd.isnull(value) or (isinstance(value, str) and value.strip() == ''):
+				row_data[key] = None
+		records.append(row_data)
+	return records
+
+
+# columns that are set by the importers or the DB, never in a downloaded CSV
+generated_columns = ('id', 'charge_number', 'calendar_id', 'row_hash', 'created_at', 'pulled', 'imported')
+
+
+# Build a CSV for a model with made up values (including blanks) so the benchmarks can run without downloaded files.
+# Charges get a unique charge_number column like the monthly exports
+def build_sample_csv(model, rows=2000, seed=1):
+	rng = random.Random(seed)
+	columns = [column for column in model.__table__.columns if column.name not in generated_columns]
+
+	def sample_value(column):
+		if rng.random() < 0.15:
+			return rng.choice(['', ' '])
+		if isinstance(column.type, DateTime):
+			return f"{rng.randint(1, 12)}/{rng.randint(1, 28)}/2024 {rng.randint(1, 12)}:{rng.randint(10, 59)}:00 {rng.choice(['AM', 'PM'])}"
+		if isinstance(column.type, Date):
+			return f"{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}/2024"
+		if isinstance(column.type, Integer):
+			return str(rng.randint(1, 999999))
+		if isinstance(column.type, Float):
+			return f"{rng.uniform(0, 5000):.2f}"
+		return rng.choice(['Kohls', 'Open', 'Closed', 'Short Ship', 'Late ASN'])
+
+	if model is Charge:
+		lines = [",".join(["charge_number"] + [column.name for column in columns])]
+		for row in range(rows):
+			lines.append(",".join([str(row + 1)] + [sample_value(column) for column in columns]))
+	else:
+		lines = [",".join(column.name for column in columns)]
+		for _ in range(rows):
+			lines.append(",".join(sample_value(column) for column in columns))
+	return "\n".join(lines)
+
+
+# Read every downloaded CSV of a tab into one data frame, or a generated sample when nothing was downloaded yet
+def load_tab_frame(subdir, model, rows=2000):
+	tab_directory = os.path.join(downloads_dir, subdir)
+	frames = []
+	if os.path.isdir(tab_directory):
+		for file in os.listdir(tab_directory):
+			if file.endswith('.csv'):
+				frames.append(pd.read_csv(os.path.join(tab_directory, file)))
+	if frames:
+		df = pd.concat(frames, ignore_index=True)
+	else:
+		df = pd.read_csv(io.StringIO(build_sample_csv(model, rows)))
+	df.columns = [normalize_column_name(column) for column in df.columns]
+	return df
+
+
+# Compare legacy_prepare_records and prepare_records for every tab: check they produce the same records and print
+# the time each took and the speedup
+def benchmark_row_preparation(rows=2000, repeat=3):
+	print(f"\n{'Tab':<24}{'Rows':>8}{'Legacy (s)':>14}{'Columnar (s)':>14}{'Speedup':>10}")
+	for subdir, model in model_map.items():
+		df = load_tab_frame(subdir, model, rows)
+		datetime_fields = date_fields.get(subdir, [])
+
+		legacy_time = columnar_time = float('inf')
+		# silence the per value 'Failed to convert' messages so only the preparation itself is timed
+		with contextlib.redirect_stdout(io.StringIO()):
+			for _ in range(repeat):
+				start_time = time.perf_counter()
+				legacy = legacy_prepare_records(df, datetime_fields)
+				legacy_time = min(legacy_time, time.perf_counter() - start_time)
+
+				start_time = time.perf_counter()
+				columnar = prepare_records(df, datetime_fields)
+				columnar_time = min(columnar_time, time.perf_counter() - start_time)
+
+		if legacy != columnar:
+			print(f"{subdir}: prepared records do not match the legacy output")
+		speedup = legacy_time / columnar_time if columnar_time > 0 else float('inf')
+		print(f"{subdir:<24}{len(df):>8}{legacy_time:>14.4f}{columnar_time:>14.4f}{speedup:>9.1f}x")
+
+
+# Get the CSV files to parse for a tab (or the monthly Charges files in charge_files when subdir is None). When nothing
+# was downloaded yet a generated sample is written to sample_directory instead
+def get_csv_files(subdir, model, sample_directory, rows=2000):
+	tab_directory = os.path.join(downloads_dir, subdir or "charge_files")
+	files = []
+	if os.path.isdir(tab_directory):
+		files = [os.path.join(tab_directory, file) for file in os.listdir(tab_directory) if file.endswith('.csv')]
+	if not files:
+		sample_path = os.path.join(sample_directory, f"{(subdir or 'Charges').replace(' ', '_')}.csv")
+		with open(sample_path, 'w') as sample_file:
+			sample_file.write(build_sample_csv(model, rows))
+		files = [sample_path]
+	return files
+
+
+# Parse files with a read function and return the best time of repeat runs, the peak memory allocated while parsing
+# and the memory held by the resulting data frames (in bytes). Memory is traced in a separate run, tracing slows down
+# every allocation and would skew the times
+def measure_parsing(files, read, repeat=3):
+	elapsed = float('inf')
+	for _ in range(repeat):
+		start_time = time.perf_counter()
+		frames = [read(file) for file in files]
+		elapsed = min(elapsed, time.perf_counter() - start_time)
+
+	tracemalloc.start()
+	frames = [read(file) for file in files]
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	held = sum(df.memory_usage(deep=True).sum() for df in frames)
+	return elapsed, peak, held, frames
+
+
+# Convert the numbers read_csv left as text (a column with a blank space in it is read as strings) to the type of
+# their field, like the ORM does when the record is written. Used to compare untyped and typed records
+def coerce_records(model, records):
+	numeric_types = {}
+	for column in model.__table__.columns:
+		if isinstance(column.type, Integer):
+			numeric_types[column.name] = lambda value: int(float(value))
+		elif isinstance(column.type, Float):
+			numeric_types[column.name] = float
+
+	for record in records:
+		for field, value in record.items():
+			if field in numeric_types and value is not None:
+				record[field] = numeric_types[field](value)
+	return records
+
+
+# Compare parsing every CSV with read_csv and then mapping the columns (before) against load_import_csv, which only
+# parses the model's columns straight into their types (after). Checks both prepare the same records and prints the
+# time, peak memory and data frame size of each per tab and for the Charges files. Generated samples are written to a
+# temporary directory that is removed afterwards
+def benchmark_csv_parsing(rows=2000):
+	sample_directory = tempfile.mkdtemp(prefix='benchmark_samples_')
+	try:
+		compare_csv_parsing(sample_directory, rows)
+	finally:
+		shutil.rmtree(sample_directory, ignore_errors=True)
+
+
+def compare_csv_parsing(sample_directory, rows):
+	tabs = [(subdir, model, date_fields.get(subdir, [])) for subdir, model in model_map.items()]
+	tabs.append((None, Charge, ['transmitted']))
+
+	megabyte = 1024 * 1024
+	print(f"\n{'File':<24}{'Before (s)':>12}{'After (s)':>12}{'Peak before':>14}{'Peak after':>14}{'Frame before':>14}{'Frame after':>14}")
+	for subdir, model, datetime_fields in tabs:
+		files = get_csv_files(subdir, model, sample_directory, rows)
+		with contextlib.redirect_stdout(io.StringIO()):
+			before_time, before_peak, before_held, before_frames = measure_parsing(
+				files, lambda file: apply_import_plan(pd.read_csv(file), model)
+			)
+			after_time, after_peak, after_held, after_frames = measure_parsing(
+				files, lambda file: load_import_csv(file, model)
+			)
+			before = [coerce_records(model, prepare_records(df, datetime_fields)) for df in before_frames]
+			after = [prepare_records(df, datetime_fields) for df in after_frames]
+
+		name = subdir or 'Charges'
+		if before != after:
+			print(f"{name}: typed parsing prepares different records than read_csv")
+		print(
+			f"{name:<24}{before_time:>12.4f}{after_time:>12.4f}"
+			f"{before_peak / megabyte:>12.2f}MB{after_peak / megabyte:>12.2f}MB"
+			f"{before_held / megabyte:>12.2f}MB{after_held / megabyte:>12.2f}MB"
+		)
+
+
+# Time preparing the tab files of charges Charges (generated samples) with prepare_charge_tabs in pools of each worker
+# count, to see how the parallel related data import scales with the cores available. The samples are written to a
+# temporary directory that is removed afterwards
+def benchmark_parallel_preparation(charges=40, rows=500, worker_counts=None):
+	sample_directory = tempfile.mkdtemp(prefix='benchmark_charges_')
+	try:
+		time_parallel_preparation(sample_directory, charges, rows, worker_counts)
+	finally:
+		shutil.rmtree(sample_directory, ignore_errors=True)
+
+
+def time_parallel_preparation(sample_directory, charges, rows, worker_counts):
+	charge_ids = list(range(1, charges + 1))
+	for subdir, model in model_map.items():
+		os.makedirs(os.path.join(sample_directory, subdir), exist_ok=True)
+		sample = build_sample_csv(model, rows)
+		for charge in charge_ids:
+			with open(os.path.join(sample_directory, subdir, f"{subdir}_{charge}.csv"), 'w') as sample_file:
+				sample_file.write(sample)
+
+	cores = os.cpu_count() or 1
+	worker_counts = worker_counts or sorted({1, max(1, cores // 2), cores})
+	print(f"\n{'Workers':>8}{'Charges':>10}{'Seconds':>10}{'Charges/sec':>14}   ({cores} cores)")
+	for workers in worker_counts:
+		with contextlib.redirect_stdout(io.StringIO()):
+			start_time = time.perf_counter()
+			with ProcessPoolExecutor(max_workers=workers) as executor:
+				for _ in executor.map(prepare_charge_tabs, [sample_directory] * charges, charge_ids):
+					pass
+			elapsed = time.perf_counter() - start_time
+		print(f"{workers:>8}{charges:>10}{elapsed:>10.2f}{charges / elapsed:>14.2f}")
+
+if __name__ == '__main__':
+	benchmark_row_preparation()
+	benchmark_csv_parsing(rows=20000)
+	benchmark_parallel_preparation()
@@ -0,0 +1,94 @@
+import os
+import sys
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(parentdir)
+
+from sqlalchemy import select, insert, update, text
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+
+# SQL Server rejects statements with more than 2100 bound parameters, keep MERGE batches under that
+MSSQL_MAX_PARAMS = 2000
+
+
+# split a list into lists of at most size items
+def chunked(items, size):
+	for i in range(0, len(items), size):
+		yield items[i:i + size]
+
+
+# Fetch existing rows of a model by primary key in as few queries as possible (IN lists are chunked to stay under
+# the driver's parameter limits). Returns a dictionary of {id: {column: value}}
+def fetch_existing_rows(session, model, ids, columns, chunk_size=1000):
+	table = model.__table__
+	# always select the primary key so rows can be keyed by it
+	selected = [table.c.id] + [table.c[column] for column in columns if column != 'id']
+	existing = {}
+	for chunk in chunked(list(ids), chunk_size):
+		result = session.execute(select(*selected).where(table.c.id.in_(chunk)))
+		for row in result.mappings():
+			existing[row['id']] = dict(row)
+	return existing
+
+
+# MySQL: multi-row INSERT ... ON DUPLICATE KEY UPDATE
+def _mysql_upsert(session, table, rows, columns, batch_size):
+	for batch in chunked(rows, batch_size):
+		statement = mysql_insert(table).values(batch)
+		statement = statement.on_duplicate_key_update(
+			{column: statement.inserted[column] for column in columns if column != 'id'}
+		)
+		session.execute(statement)
+
+
+# SQL Server: MERGE against a VALUES list of bound parameters
+def _mssql_merge(session, table, rows, columns):
+	quote = session.get_bind().dialect.identifier_preparer.quote
+	quoted = [quote(column) for column in columns]
+	updates = ", ".join(f"target.{q} = source.{q}" for column, q in zip(columns, quoted) if column != 'id')
+	batch_size = max(1, MSSQL_MAX_PARAMS // len(columns))
+
+	for batch in chunked(rows, batch_size):
+		params = {}
+		values = []
+		for i, row in enumerate(batch):
+			names = []
+			for j, column in enumerate(columns):
+				name = f"p{i}_{j}"
+				params[name] = row.get(column)
+				names.append(f":{name}")
+			values.append(f"({', '.join(names)})")
+
+		statement = (
+			f"MERGE {quote(table.name)} WITH (HOLDLOCK) AS target "
+			f"USING (VALUES {', '.join(values)}) AS source ({', '.join(quoted)}) "
+			f"ON target.{quote('id')} = source.{quote('id')} "
+			f"WHEN MATCHED THEN UPDATE SET {updates} "
+			f"WHEN NOT MATCHED THEN INSERT ({', '.join(quoted)}) "
+			f"VALUES ({', '.join(f'source.{q}' for q in quoted)});"
+		)
+		session.execute(text(statement), params)
+
+
+# Write already diffed rows as batched statements. inserts/updates are lists of dictionaries with the same keys.
+# MySQL and SQL Server get a native upsert so a row inserted by another run in the meantime does not fail the batch,
+# any other dialect (e.g. a local SQLite copy) falls back to executemany INSERT and UPDATE-by-primary-key
+def write_rows(session, model, inserts, updates, batch_size=500):
+	rows = inserts + updates
+	if not rows:
+		return
+
+	table = model.__table__
+	columns = list(rows[0].keys())
+	dialect = session.get_bind().dialect.name
+
+	if dialect == 'mysql':
+		_mysql_upsert(session, table, rows, columns, batch_size)
+	elif dialect == 'mssql':
+		_mssql_merge(session, table, rows, columns)
+	else:
+		if inserts:
+			session.execute(insert(model), inserts)
+		if updates:
+			session.execute(update(model), updates)
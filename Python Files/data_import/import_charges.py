@@ -5,12 +5,17 @@ currentdir = os.path.dirname(os.path.realpath(__file__))
 parentdir = os.path.dirname(currentdir)
 sys.path.append(parentdir)
 
-from models import Calendar, Charge
-import pandas as pd
-from datetime import datetime, timedelta
+from models import Calendar, Charge, ImportCheckpoint
+from datetime import datetime, date, timedelta
 import os
+import time
+import hashlib
+from sqlalchemy import update
 from data_recruitment.csv_scraper import downloads_dir
-from main import setup_database, normalize_column_name, convert_to_datetime
+from main import setup_database, prepare_records, read_import_csv, load_import_csv
+from data_import.bulk_ops import fetch_existing_rows, write_rows
+from data_import.manifest import get_calendar_file
+from data_import.journal import clear_journal
 
 
 # Get all Calendars that were pulled and need to be imported
@@ -25,8 +30,15 @@ def get_unimported_calendars(session):
 	return calendars
 
 
-# Get Charges CSV file using passed in Calendar instance
-def get_file_to_import(calendar):
+# Get Charges CSV file using passed in Calendar instance. When a DB session is passed in the download manifest is
+# checked first, the directory is only searched for files downloaded before the manifest existed
+def get_file_to_import(calendar, session=None):
+	if session is not None:
+		manifest_file = get_calendar_file(session, calendar)
+		if manifest_file:
+			print(f"Found file for {calendar.month}-{calendar.year}: {os.path.basename(manifest_file)}")
+			return manifest_file
+
 	# directory where charge files are downloaded
 	directory = os.path.join(downloads_dir, "charge_files")
 	if not os.path.isdir(directory):
@@ -44,70 +56,131 @@ def get_file_to_import(calendar):
 	return None
 
 
+# Charge columns that are not part of the CSV data and are left out of its fingerprint
+untracked_columns = ('id', 'pulled', 'imported', 'row_hash')
+# fingerprints stored before calendar_id was part of them, see stored_fingerprint
+legacy_untracked_columns = untracked_columns + ('calendar_id',)
+
+
+# turn a value into the text used for fingerprinting, so the same data hashes the same whether it comes from the CSV
+# or from the DB (e.g. 5001 vs 5001.0). Charge floats are money amounts, they are compared to the cent
+def fingerprint_value(value):
+	if value is None:
+		return ''
+	if isinstance(value, float):
+		if value != value:  # NaN
+			return ''
+		value = round(value, 2)
+		return str(int(value)) if value.is_integer() else repr(value)
+	if isinstance(value, (datetime, date)):
+		return value.isoformat()
+	return str(value)
+
+
+# SHA-256 of a prepared Charge row (the columns that come from the CSV and its Calendar), stored on Charge.row_hash
+def charge_fingerprint(row_data, excluded_columns=untracked_columns):
+	parts = [
+		f"{column}={fingerprint_value(row_data[column])}"
+		for column in sorted(row_data) if column not in excluded_columns
+	]
+	return hashlib.sha256("\x1f".join(parts).encode('utf-8')).hexdigest()
+
+
+# The fingerprint to compare a row against. A fingerprint stored without calendar_id matches the row's legacy
+# fingerprint when nothing changed and the Charge is still in the same month, the row's fingerprint is returned then
+# so the Charge is only given the new fingerprint (backfilled) instead of being reset
+def stored_fingerprint(stored_hash, stored_calendar_id, row_data):
+	if (
+		stored_hash and stored_hash != row_data['row_hash'] and stored_calendar_id == row_data['calendar_id']
+		and stored_hash == charge_fingerprint(row_data, legacy_untracked_columns)
+	):
+		return row_data['row_hash']
+	return stored_hash
+
+
+# Charge columns whose change means the Charge's related data has to be scraped again in an incremental import.
+# Other changes only update the Charge itself
+rescrape_columns = ('status', 'amount')
+
+
+# True when the status or amount of a stored Charge (dictionary of its values) differs from the CSV row's.
+# Columns the CSV does not have are not compared
+def needs_rescrape(stored, row_data):
+	return any(
+		fingerprint_value(stored.get(column)) != fingerprint_value(row_data[column])
+		for column in rescrape_columns if column in row_data
+	)
+
+
+# update an existing Charge in place with the row data, keeping its pulled/imported flags
+def refresh_charge(charge, row_data):
+	for column, value in row_data.items():
+		setattr(charge, column, value)
+
+
+# update an existing Charge in place with the row data and mark it unpulled and unimported so it gets reprocessed
+def update_charge(charge, row_data):
+	refresh_charge(charge, row_data)
+	charge.pulled = False
+	charge.imported = False
+
+
 # Process and import Charge CSV data into DB.
 # params:
 # Calendar instance to relate Charge to
 # File to process
 # Days back from current date to automatically update existing Charge with CSV data (based off 'transmitted' column)
-def process_file_data(session, calendar, file, days):
+# incremental: skip that refresh and only send a changed Charge back to be scraped when its status or amount changed
+# (see needs_rescrape), other changes are written without resetting it
+def process_file_data(session, calendar, file, days, incremental=False):
 	try:
-		# Create data frame from CSV file
-		df = pd.read_csv(file)
-		# Normalize the CSVs column names to match up with the DB/Model's column names
-		df.columns = [normalize_column_name(column) for column in df.columns]
+		# Create data frame from CSV file. Only the columns with a Charge field are parsed, into the field's types, and
+		# named after the DB/Model's columns (charge_number becomes id)
+		df = load_import_csv(file, Charge)
 
 		# Calculate the date n days back from current date
 		days_threshold = datetime.now() - timedelta(days=days)
+		# Charges reset to be scraped again, their scrape journal is dropped so every tab is scraped
+		reset_charges = []
 
-		# Each row represents a Charge instance
-		for _, row in df.iterrows():
-			row_data = row.to_dict()  # Convert the row to a dictionary to capture all columns
-			row_data['id'] = row_data.pop('charge_number')  # Map charge_number to id
+		# Each row represents a Charge instance. Dates are parsed and empty values converted to None column by column
+		for row_data in prepare_records(df, ['transmitted']):
 			row_data['calendar_id'] = calendar.id  # Assign calendar_id
-			row_data['transmitted'] = convert_to_datetime(row_data['transmitted'])  # handle date type
 
-			# Handle empty values
-			for key, value in row_data.items():
-				if pd.isnull(value) or (isinstance(value, str) and value.strip() == ''):
-					# Convert the empty value to None to ensure compliance with python null type
-					row_data[key] = None
+			# Fingerprint of the row, compared against the one stored on the Charge to detect changes
+			row_data['row_hash'] = charge_fingerprint(row_data)
 
 			# Check if Charge already exists in the database
 			existing_charge = session.query(Charge).filter_by(id=row_data['id']).first()
 			# Grab the current row's transmitted date
 			row_transmitted_date = row_data.get('transmitted')
-			# Flag to track if any value in this row has changed compared to the DB (when Charge already exists within DB)
-			data_changed = False
 
 			if existing_charge:
-				# Determine if any data in the row has changed
-				data_changed = any(
-					getattr(existing_charge, column) != row_data[column]
-					for column in row_data if column in existing_charge.__dict__
-				)
-
-				# If the transmitted date is within the day threshold, we are going to replace the existing Charge instance
-				if row_transmitted_date and row_transmitted_date >= days_threshold:
+				# Charges imported before fingerprints were stored get one computed from their current values
+				stored_hash = stored_fingerprint(
+					existing_charge.row_hash, existing_charge.calendar_id, row_data
+				) or charge_fingerprint({column: getattr(existing_charge, column, None) for column in row_data})
+				# Flag to track if any value in this row has changed compared to the DB
+				data_changed = stored_hash != row_data['row_hash']
+
+				if incremental and data_changed and not needs_rescrape(
+					{column: getattr(existing_charge, column, None) for column in rescrape_columns}, row_data
+				):
+					print(f"Updating Charge {existing_charge.id} - Reason: data changed, status and amount unchanged...")
+					refresh_charge(existing_charge, row_data)
+				# If the transmitted date is within the day threshold, we are going to refresh the existing Charge instance
+				elif not incremental and row_transmitted_date and row_transmitted_date >= days_threshold:
 					print(f"Updating Charge {existing_charge.id} - Reason: transmitted in past {days} days...")
-					session.delete(existing_charge)
-					# Create new Charge instance with dictionary containing processed row data
-					new_charge = Charge(**row_data)
-					# manually update the new Charge as unpulled and unimported to ensure it gets reprocessed in later steps
-					new_charge.pulled = False
-					new_charge.imported = False
-					# Add the new (updated) Charge
-					session.add(new_charge)
-				# If any data has changed, we are going to replace the existing Charge instance
+					update_charge(existing_charge, row_data)
+					reset_charges.append(existing_charge.id)
+				# If any data has changed, we are going to update the existing Charge instance
 				elif data_changed:
 					print(f"Updating Charge {existing_charge.id} - Reason: data changed...")
-					session.delete(existing_charge)
-					# Create new Charge instance with dictionary containing processed row data
-					new_charge = Charge(**row_data)
-					# manually update the new Charge as unpulled and unimported to ensure it gets reprocessed in later steps
-					new_charge.pulled = False
-					new_charge.imported = False
-					# Add the new (updated) Charge
-					session.add(new_charge)
+					update_charge(existing_charge, row_data)
+					reset_charges.append(existing_charge.id)
+				elif existing_charge.row_hash != row_data['row_hash']:
+					# Unchanged, just store the (current) fingerprint for the next run
+					existing_charge.row_hash = row_data['row_hash']
 			else:
 				print(f"Adding new Charge {row_data['id']}...")
 				# If the Charge does not already exist in the DB, then just create a new one with the row_data dictionary
@@ -116,6 +189,7 @@ def process_file_data(session, calendar, file, days):
 				new_charge.imported = False
 				session.add(new_charge)  # Add new charge to the session
 
+		clear_journal(session, reset_charges)
 		# Commit all changes to the DB
 		session.commit()
 		print(f"File Processed.")
@@ -127,19 +201,207 @@ def process_file_data(session, calendar, file, days):
 		return False
 
 
+# Diff a data frame of Charge rows (columns already named after the Charge fields, see read_import_csv) against the DB
+# and write the changes as batched statements (does not commit).
+# Same rules as process_file_data for new/refreshed/changed Charges, but the existing Charges are prefetched in one
+# pass and their fingerprints compared in memory. Returns the number of rows inserted, updated and skipped
+# incremental: like process_file_data, Charges whose status and amount did not change keep their pulled/imported flags
+def upsert_charge_frame(session, calendar, df, days_threshold, incremental=False):
+	# Prepare every row first, keyed by Charge ID (the last occurrence wins if a Charge is listed twice)
+	rows = {}
+	for row_data in prepare_records(df, ['transmitted']):
+		row_data['calendar_id'] = calendar.id
+		row_data['row_hash'] = charge_fingerprint(row_data)
+
+		# Charges that get written are always reset so they are reprocessed in later steps
+		row_data['pulled'] = False
+		row_data['imported'] = False
+		rows[row_data['id']] = row_data
+
+	if not rows:
+		return 0, 0, 0
+
+	# CSV columns, only needed to fingerprint Charges that were imported before fingerprints were stored
+	csv_columns = [column for column in next(iter(rows.values())) if column not in untracked_columns]
+	# Grab all the Charges in this frame that already exist in the DB
+	existing = fetch_existing_rows(session, Charge, rows.keys(), csv_columns + ['row_hash'])
+
+	inserts, updates, refreshes, backfills = [], [], [], []
+	skipped = 0
+	for charge_id, row_data in rows.items():
+		existing_charge = existing.get(charge_id)
+		if existing_charge is None:
+			inserts.append(row_data)
+			continue
+
+		stored_hash = stored_fingerprint(
+			existing_charge['row_hash'], existing_charge['calendar_id'], row_data
+		) or charge_fingerprint(existing_charge)
+		row_transmitted_date = row_data.get('transmitted')
+		if incremental and stored_hash != row_data['row_hash'] and not needs_rescrape(existing_charge, row_data):
+			# its related data did not change, update the Charge without resetting it
+			refreshes.append({column: value for column, value in row_data.items() if column not in ('pulled', 'imported')})
+		elif not incremental and row_transmitted_date and row_transmitted_date >= days_threshold:
+			# transmitted within the day threshold, always refresh
+			updates.append(row_data)
+		elif stored_hash != row_data['row_hash']:
+			updates.append(row_data)
+		else:
+			skipped += 1
+			if existing_charge['row_hash'] != row_data['row_hash']:
+				backfills.append({'id': charge_id, 'row_hash': row_data['row_hash']})
+
+	write_rows(session, Charge, inserts, updates)
+	# the reset Charges are scraped again from the first tab
+	clear_journal(session, [row_data['id'] for row_data in updates])
+	# written apart, every row of a batch has to set the same columns
+	write_rows(session, Charge, [], refreshes)
+	if backfills:
+		# store the fingerprint of unchanged Charges without resetting them
+		session.execute(update(Charge), backfills)
+	return len(inserts), len(updates) + len(refreshes), skipped
+
+
+# print the counts and speed of a bulk or streaming import
+def print_import_report(inserted, updated, skipped, start_time):
+	total = inserted + updated + skipped
+	elapsed = time.time() - start_time
+	rate = round(total / elapsed, 2) if elapsed > 0 else total
+	print(
+		f"File Processed. Inserted: {inserted} | Updated: {updated} | Skipped: {skipped} | "
+		f"{total} rows in {round(elapsed, 2)} Seconds ({rate} rows/sec)"
+	)
+
+
+# Bulk version of process_file_data: the whole file is diffed and written with upsert_charge_frame in one transaction
+def bulk_process_file_data(session, calendar, file, days, incremental=False):
+	try:
+		start_time = time.time()
+		# Calculate the date n days back from current date
+		days_threshold = datetime.now() - timedelta(days=days)
+
+		inserted, updated, skipped = upsert_charge_frame(
+			session, calendar, load_import_csv(file, Charge), days_threshold, incremental
+		)
+		# Commit all changes to the DB
+		session.commit()
+		print_import_report(inserted, updated, skipped, start_time)
+		return True
+	except Exception as e:
+		session.rollback()
+		print(f"Error occurred while processing file: {e}")
+		return False
+
+
+# Get the checkpoint of a Charges file, creating it if needed. A checkpoint left by a different download of the file
+# (size or modified time changed, e.g. the month was re-exported) starts over from the first row
+def get_import_checkpoint(session, calendar, file):
+	file_name = os.path.basename(file)
+	file_size = os.path.getsize(file)
+	file_modified = datetime.fromtimestamp(os.path.getmtime(file)).replace(microsecond=0)
+
+	checkpoint = session.query(ImportCheckpoint).filter_by(calendar_id=calendar.id, file_name=file_name).first()
+	if checkpoint and (checkpoint.file_size != file_size or checkpoint.file_modified != file_modified):
+		print(f"{file_name} changed since the last import, starting from the first row...")
+		checkpoint.file_size = file_size
+		checkpoint.file_modified = file_modified
+		checkpoint.last_row = 0
+		checkpoint.completed = False
+	elif not checkpoint:
+		checkpoint = ImportCheckpoint(
+			calendar_id=calendar.id,
+			file_name=file_name,
+			file_size=file_size,
+			file_modified=file_modified,
+			last_row=0,
+			completed=False
+		)
+		session.add(checkpoint)
+	session.commit()
+	return checkpoint
+
+
+# Streaming version of bulk_process_file_data for very large exports. The file is read chunk_size rows at a time and
+# every chunk is committed together with the file's checkpoint, so a failed run resumes after the last committed row
+# instead of starting the month over
+def stream_process_file_data(session, calendar, file, days, chunk_size=5000, incremental=False):
+	try:
+		start_time = time.time()
+		days_threshold = datetime.now() - timedelta(days=days)
+
+		checkpoint = get_import_checkpoint(session, calendar, file)
+		if checkpoint.completed:
+			print(f"File already imported.")
+			return True
+		if checkpoint.last_row:
+			print(f"Resuming from row {checkpoint.last_row}...")
+
+		inserted = updated = skipped = 0
+		# Chunks are parsed into the Charge field types. A value that does not fit its type (only found when its chunk
+		# is parsed) rolls back that chunk and the file is read again untyped, resuming from the checkpoint
+		for typed in (True, False):
+			try:
+				reader, plan = read_import_csv(file, Charge, typed=typed, chunksize=chunk_size)
+				rows_read = 0
+				# Rows before the checkpoint are still parsed (a quoted value can span lines, so skipping by line number
+				# is not safe) but not written again
+				for chunk in reader:
+					chunk_start = rows_read
+					rows_read += len(chunk)
+					if rows_read <= checkpoint.last_row:
+						continue
+					if chunk_start < checkpoint.last_row:
+						chunk = chunk.iloc[checkpoint.last_row - chunk_start:]
+
+					chunk_inserted, chunk_updated, chunk_skipped = upsert_charge_frame(
+						session, calendar, plan.apply_selected(chunk, typed), days_threshold, incremental
+					)
+					inserted += chunk_inserted
+					updated += chunk_updated
+					skipped += chunk_skipped
+
+					# the checkpoint is committed in the same transaction as the chunk's data
+					checkpoint.last_row = rows_read
+					session.commit()
+					print(f"Committed rows up to {rows_read}")
+				break
+			except (ValueError, TypeError) as e:
+				if not typed:
+					raise
+				session.rollback()
+				print(f"Could not parse {os.path.basename(file)} with the Charge types ({e}), reading it untyped...")
+
+		checkpoint.completed = True
+		session.commit()
+		print_import_report(inserted, updated, skipped, start_time)
+		return True
+	except Exception as e:
+		session.rollback()
+		print(f"Error occurred while processing file: {e}")
+		return False
+
+
 # Function with process to import Charges to be used in full_process.py. Takes in a DB session
-def import_charges_process(session):
+# bulk=True imports each file with bulk_process_file_data instead of row by row,
+# streaming=True imports it in committed chunks of chunk_size rows with stream_process_file_data
+# incremental=True only resets the Charges whose status or amount changed (see process_file_data)
+def import_charges_process(session, bulk=False, streaming=False, chunk_size=5000, incremental=False):
 	try:
 		# Get unimported Calendars
 		months = get_unimported_calendars(session)
 		for month in months:
 			print(f"\nFinding file for {month.month}-{month.year}...")
 			# Find Charges CSV that was pulled using this Calendar instance
-			charge_file = get_file_to_import(month)
+			charge_file = get_file_to_import(month, session)
 			if charge_file:
 				print(f"Processing file data...")
 				# Process the Charge CSVs data and  import to DB. (returns True if processing is successful)
-				processed = process_file_data(session, month, charge_file, 45)
+				if streaming:
+					processed = stream_process_file_data(session, month, charge_file, 45, chunk_size, incremental)
+				elif bulk:
+					processed = bulk_process_file_data(session, month, charge_file, 45, incremental)
+				else:
+					processed = process_file_data(session, month, charge_file, 45, incremental)
 				if processed:
 					print(f"Marking {month.month}-{month.year} Imported.")
 					# Only mark the Calendar imported if the importing process completes successfully
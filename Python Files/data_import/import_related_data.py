@@ -5,13 +5,22 @@ currentdir = os.path.dirname(os.path.realpath(__file__))
 parentdir = os.path.dirname(currentdir)
 sys.path.append(parentdir)
 
+import io
+import time
 import pandas as pd
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy import delete, insert, update, select
 from data_import.models import (
-	Charge
+	Charge,
+	Attachment
 )
 
-from data_import.main import normalize_column_name, convert_to_datetime, setup_database, model_map, date_fields
-from data_recruitment.csv_scraper import downloads_dir
+from data_import.main import load_import_csv, prepare_records, setup_database, model_map, date_fields, get_import_plan
+from data_import.manifest import get_unimported_charge_files
+from data_import.journal import get_tab_journal, record_tab, clear_journal, tab_stored, tab_imported
+from data_import.bulk_ops import chunked
+from data_recruitment.csv_scraper import downloads_dir, combined_dir
 
 
 # Get all Charges that were pulled and need to be imported
@@ -47,16 +56,44 @@ def drop_all_related_data(session, charge, model):
 		return False
 
 
+# Find the CSV file of a Charge for a tab subdirectory. Returns None if the Charge has no file for that tab
+# files: the Charge's {tab: file path} entries from the download manifest. When not passed in, the subdirectory is
+# searched for the Charge's file instead (files downloaded before the manifest existed). A recorded file that has been
+# moved or deleted since is searched for the same way
+def find_csv_path(directory, subdir, charge, files=None):
+	if files is not None:
+		csv_path = files.get(subdir)
+		# Tabs without a recorded download had no data to export
+		if not csv_path:
+			print(f"\n      No CSV file recorded for {subdir}, skipping.")
+			return None
+		if os.path.exists(csv_path):
+			return csv_path
+		print(f"\n      Recorded CSV file {csv_path} for {subdir} no longer exists, searching {directory}")
+
+	# Search for a file in subdirectory containing the Charge's ID
+	csv_path = os.path.join(directory, subdir, f"{subdir}_{charge}.csv")
+	if not os.path.exists(csv_path):
+		print(f"\n      No CSV file found for {subdir} at {csv_path}, skipping.")
+		return None
+	return csv_path
+
+
 # Find, process, and store file data related to Charge
-def store_csv_data(session, directory, charge):
+# Each tab is committed together with its entry in the scrape journal, tabs the journal already has as imported (or
+# stored straight from the DOM) are skipped, so a Charge that failed part way resumes at the tab it stopped on
+def store_csv_data(session, directory, charge, files=None):
 	try:
+		journal = get_tab_journal(session, charge)
 		# Use dictionary that maps subdirectories to the appropriate models to search for and store data
 		for subdir, model in model_map.items():
-			# Search for a file in subdirectory containing the Charge's ID
-			csv_path = os.path.join(directory, subdir, f"{subdir}_{charge}.csv")
+			if subdir in journal and journal[subdir].status in (tab_imported, tab_stored):
+				print(f"\n      {subdir} already imported, skipping.")
+				continue
+
+			csv_path = find_csv_path(directory, subdir, charge, files)
 			# If such file does not exist, continue to the next subdirectory
-			if not os.path.exists(csv_path):
-				print(f"\n      No CSV file found for {subdir} at {csv_path}, skipping.")
+			if not csv_path:
 				continue
 
 			print(f"\n      Processing files in {subdir}...")
@@ -69,30 +106,16 @@ def store_csv_data(session, directory, charge):
 				continue
 
 			print("        Preparing file data...")
-			# Create data frame from CSV
-			df = pd.read_csv(csv_path)
-
-			# normalize column names to match up with DB/Model field names
-			df.columns = [normalize_column_name(col) for col in df.columns]
+			# Create data frame from CSV, only parsing the columns the model has fields for (in the fields' types)
+			# and naming them after the DB/Model fields with the cached import plan
+			df = load_import_csv(csv_path, model)
 
 			# get the date fields for the current subdir/model for processing using dictionary that maps subdirectories to date fields
 			datetime_fields = date_fields.get(subdir, [])
 
-			# iterate through the rows of the combined file's data frame (each row represents a record)
-			for index, row in df.iterrows():
-				# Convert row to dictionary
-				row_data = row.to_dict()
-
-				# parse date values to valid Date/Datetime types using mapped date fields when necessary
-				for field in datetime_fields:
-					if field in row_data:
-						row_data[field] = convert_to_datetime(row_data[field])
-
-				# Clean empty or null values
-				for key, value in row_data.items():
-					if pd.isnull(value) or (isinstance(value, str) and value.strip() == ''):
-						row_data[key] = None  # or set to some default value, like ''
-
+			# parse date values to valid Date/Datetime types and clean empty or null values a column at a time,
+			# then iterate through the prepared rows (each row represents a record)
+			for row_data in prepare_records(df, datetime_fields):
 				# since DB fields mimic normalized column headers we can just pass the row in using kwargs
 				# this dynamically creates records of any type
 				record = model(**row_data)
@@ -100,6 +123,9 @@ def store_csv_data(session, directory, charge):
 				record.charge_number = charge
 				# add the new record to the session
 				session.add(record)
+			# commit the tab's records with its journal entry
+			record_tab(session, charge, subdir, tab_imported, csv_path, commit=False)
+			session.commit()
 			print(f"      Data processed.")
 
 		# commit all added records to the DB
@@ -113,20 +139,308 @@ def store_csv_data(session, directory, charge):
 		return False
 
 
+# Read and prepare a tab's CSV file for a set based insert. Returns a list of dictionaries holding every column of the
+# model except the ID (every row needs the same keys for executemany)
+def prepare_tab_records(csv_path, subdir, model):
+	columns = [column.name for column in model.__table__.columns if column.name != 'id']
+	df = load_import_csv(csv_path, model)
+	return [
+		{column: row_data.get(column) for column in columns}
+		for row_data in prepare_records(df, date_fields.get(subdir, []))
+	]
+
+
+# Import a tab's rows read from the portal's DOM (csv_scraper.export_related_csvs with on_tab_rows) without a file:
+# the rows go through the same column mapping and typed parsing as a downloaded CSV (from an in memory CSV) and
+# replace the Charge's rows in the tab's table. The table shows amounts formatted ($1,234.50), number columns have the
+# formatting stripped first. Does not commit. Returns the number of rows stored
+def store_tab_rows(session, charge, subdir, headers, rows):
+	model = model_map[subdir]
+	df = pd.DataFrame(rows, columns=headers)
+	plan = get_import_plan(model, headers)
+	for position, header in zip(plan.positions, plan.usecols):
+		if plan.dtypes.get(header) == "float64":
+			df.iloc[:, position] = df.iloc[:, position].str.replace(r"[$,\s]", "", regex=True)
+
+	buffer = io.StringIO()
+	df.to_csv(buffer, index=False)
+	buffer.seek(0)
+	records = prepare_tab_records(buffer, subdir, model)
+	for record in records:
+		record['charge_number'] = charge
+	replace_related_rows(session, model, [charge], records)
+	return len(records)
+
+
+# Replace all rows of a model for the passed in Charges: one DELETE ... WHERE charge_number IN (...) (chunked) and one
+# executemany INSERT through SQLAlchemy Core. Attachments related to the deleted rows (Documents/Reports, see
+# get_attachments.relate_attachment) are unlinked first, like the ORM does in drop_all_related_data. Does not commit
+def replace_related_rows(session, model, charges, records):
+	table = model.__table__
+	attachment_links = [
+		column for column in Attachment.__table__.columns
+		if any(foreign_key.column.table is table for foreign_key in column.foreign_keys)
+	]
+	for charge_chunk in chunked(list(charges), 1000):
+		for column in attachment_links:
+			session.execute(
+				update(Attachment.__table__)
+				.where(column.in_(select(table.c.id).where(table.c.charge_number.in_(charge_chunk))))
+				.values({column.name: None})
+			)
+		session.execute(delete(table).where(table.c.charge_number.in_(charge_chunk)))
+	if records:
+		session.execute(insert(table), records)
+
+
+# mark Charges imported with one UPDATE per 1000 Charges. Does not commit
+def mark_charges_imported(session, charges):
+	for charge_chunk in chunked(list(charges), 1000):
+		session.execute(update(Charge).where(Charge.id.in_(charge_chunk)).values(imported=True))
+
+
+# Set based version of store_csv_data for a group of Charges: every tab's files are read and prepared, then each table
+# has its rows replaced with replace_related_rows (no ORM objects) and the Charges are marked imported with a single
+# UPDATE. Everything runs in one transaction
+# charge_files: {charge number: {tab: file path}} from the download manifest
+def store_csv_data_batch(session, directory, charges, charge_files):
+	try:
+		for subdir, model in model_map.items():
+			charges_with_file = []
+			records = []
+			for charge in charges:
+				csv_path = find_csv_path(directory, subdir, charge, charge_files.get(charge))
+				if not csv_path:
+					continue
+				charges_with_file.append(charge)
+				for record in prepare_tab_records(csv_path, subdir, model):
+					record['charge_number'] = charge
+					records.append(record)
+
+			if not charges_with_file:
+				continue
+			replace_related_rows(session, model, charges_with_file, records)
+			print(f"      {subdir}: replaced data for {len(charges_with_file)} Charges ({len(records)} rows)")
+
+		mark_charges_imported(session, charges)
+		clear_journal(session, charges)
+		session.commit()
+		return True
+	except Exception as e:
+		print(f"        Error occurred while trying to store related data: {e}")
+		session.rollback()
+		return False
+
+
+# Worker side of the parallel import, runs in a pool process without touching the DB: read and prepare every tab file
+# of a Charge. Returns the Charge number and {tab: records} for the tabs that have a file
+def prepare_charge_tabs(directory, charge, files=None):
+	tabs = {}
+	for subdir, model in model_map.items():
+		csv_path = find_csv_path(directory, subdir, charge, files)
+		if not csv_path:
+			continue
+		records = prepare_tab_records(csv_path, subdir, model)
+		for record in records:
+			record['charge_number'] = charge
+		tabs[subdir] = records
+	return charge, tabs
+
+
+# Writer side of the parallel import: replace a Charge's rows in every prepared tab and mark it imported, all in one
+# transaction so a Charge is either fully imported or left unimported like with store_csv_data
+def write_charge_tabs(session, charge, tabs):
+	try:
+		for subdir, records in tabs.items():
+			replace_related_rows(session, model_map[subdir], [charge], records)
+		mark_charges_imported(session, [charge])
+		clear_journal(session, [charge])
+		session.commit()
+		return True
+	except Exception as e:
+		print(f"        Error occurred while trying to store related data for Charge {charge}: {e}")
+		session.rollback()
+		return False
+
+
+# Parallel version of the related data import: a pool of worker processes reads and prepares the Charges' files
+# (the CPU bound part) while this process is the only DB writer. At most max_pending Charges are handed to the pool
+# ahead of the writer, which takes the prepared Charges in the original order, so memory stays bounded and Charges
+# are imported (and committed one at a time) in the same order as the sequential import
+# charge_files: {charge number: {tab: file path}} from the download manifest
+def parallel_import_related_data(session, directory, charges, charge_files, workers=None, max_pending=None):
+	workers = workers or os.cpu_count() or 1
+	max_pending = max_pending or workers * 2
+	start_time = time.time()
+	imported = failed = 0
+
+	remaining = iter(charges)
+	pending = deque()
+	with ProcessPoolExecutor(max_workers=workers) as executor:
+		# hand the next Charges to the pool until max_pending are waiting for the writer
+		def fill_pending():
+			while len(pending) < max_pending:
+				charge = next(remaining, None)
+				if charge is None:
+					return
+				pending.append((charge, executor.submit(prepare_charge_tabs, directory, charge, charge_files.get(charge))))
+
+		fill_pending()
+		while pending:
+			charge, future = pending.popleft()
+			fill_pending()
+			try:
+				_, tabs = future.result()
+			except Exception as e:
+				print(f"Error occurred while preparing files of Charge {charge}: {e}")
+				failed += 1
+				continue
+
+			if write_charge_tabs(session, charge, tabs):
+				print(f"Charge {charge}: imported {sum(len(records) for records in tabs.values())} rows from {len(tabs)} tabs.")
+				imported += 1
+			else:
+				failed += 1
+
+	elapsed = time.time() - start_time
+	rate = round(imported / elapsed, 2) if elapsed > 0 else imported
+	print(
+		f"\nImported {imported} Charges ({failed} failed) in {round(elapsed, 2)} Seconds "
+		f"({rate} Charges/sec with {workers} workers)"
+	)
+
+
+# Get the combined files (made by csv_scraper.combine_csvs) waiting to be imported. Returns {tab: [file paths]}
+# ordered oldest to newest (the timestamp in the file name sorts chronologically)
+def get_combined_files(combined_directory):
+	combined_files = {}
+	for subdir in model_map:
+		tab_directory = os.path.join(combined_directory, subdir)
+		if not os.path.isdir(tab_directory):
+			continue
+		files = sorted(
+			file for file in os.listdir(tab_directory)
+			if file.startswith(f"{subdir}_combined_") and file.endswith('.csv')
+		)
+		if files:
+			combined_files[subdir] = [os.path.join(tab_directory, file) for file in files]
+	return combined_files
+
+
+# Import the combined file(s) of every tab in one set based operation per tab and group of group_size Charges, instead
+# of reading each Charge's files. Only pulled and unimported Charges are loaded, if a Charge is in several combined
+# files of a tab the newest file wins. Each group is committed with its Charges marked imported, a group that fails
+# is rolled back on its own and its Charges stay unimported. The files are moved to combined_directory/imported once
+# every group is imported, so they are not loaded again
+def import_combined_files_process(session, combined_directory=combined_dir, group_size=500):
+	try:
+		charges_to_import = {charge.id for charge in get_unimported_charges(session)}
+		combined_files = get_combined_files(combined_directory)
+		if not combined_files:
+			print(f"No combined files found in {combined_directory}")
+			return
+
+		# {tab: {charge: records}} of the Charges waiting to be imported
+		records_by_tab = {}
+		for subdir, files in combined_files.items():
+			model = model_map[subdir]
+			print(f"\nReading {len(files)} combined file(s) for {subdir}...")
+
+			records_by_charge = {}
+			for file in files:
+				file_records = {}
+				for record in prepare_tab_records(file, subdir, model):
+					file_records.setdefault(record['charge_number'], []).append(record)
+				records_by_charge.update(file_records)
+
+			skipped = [charge for charge in records_by_charge if charge not in charges_to_import]
+			if skipped:
+				print(f"      Skipping {len(skipped)} Charges that are not waiting to be imported")
+			records_by_tab[subdir] = {
+				charge: records for charge, records in records_by_charge.items() if charge in charges_to_import
+			}
+
+		covered_charges = sorted({charge for records_by_charge in records_by_tab.values() for charge in records_by_charge})
+		imported, failed = [], []
+		for group in chunked(covered_charges, group_size):
+			try:
+				for subdir, records_by_charge in records_by_tab.items():
+					charges = [charge for charge in group if charge in records_by_charge]
+					if not charges:
+						continue
+					records = [record for charge in charges for record in records_by_charge[charge]]
+					replace_related_rows(session, model_map[subdir], charges, records)
+					print(f"      {subdir}: replaced data for {len(charges)} Charges ({len(records)} rows)")
+
+				mark_charges_imported(session, group)
+				clear_journal(session, group)
+				session.commit()
+				imported.extend(group)
+			except Exception as e:
+				session.rollback()
+				failed.extend(group)
+				print(f"Error occurred while importing Charges {group[0]} - {group[-1]} from combined files: {e}")
+
+		print(f"\nMarked {len(imported)} Charges imported.")
+		if failed:
+			print(f"{len(failed)} Charges failed and stay unimported, the combined files are left in place")
+			return
+
+		# move the imported files out of the way
+		for subdir, files in combined_files.items():
+			imported_directory = os.path.join(combined_directory, "imported", subdir)
+			if not os.path.exists(imported_directory):
+				os.makedirs(imported_directory)
+			for file in files:
+				os.replace(file, os.path.join(imported_directory, os.path.basename(file)))
+	except Exception as e:
+		session.rollback()
+		print(f"Error occurred while importing combined files: {e}")
+
+
 # Function with process to import related data to be used in full_process.py. Takes in a DB session
-def import_related_data_process(session):
+# batch_size=N imports N Charges per transaction with store_csv_data_batch instead of one Charge at a time
+# workers=N prepares the files in N processes with parallel_import_related_data (one Charge per transaction)
+def import_related_data_process(session, batch_size=None, workers=None):
 	try:
 		# Get unimported Charges
 		charges_to_import = get_unimported_charges(session)
+		# Get the downloaded files of all those Charges from the download manifest in one query
+		charge_files = get_unimported_charge_files(session)
+
+		if workers:
+			charge_ids = [charge.id for charge in charges_to_import]
+			parallel_import_related_data(session, downloads_dir, charge_ids, charge_files, workers)
+			return
+
+		if batch_size:
+			charge_ids = [charge.id for charge in charges_to_import]
+			for group in chunked(charge_ids, batch_size):
+				print(f"\nImporting related data for {len(group)} Charges ({group[0]} - {group[-1]})...")
+				if store_csv_data_batch(session, downloads_dir, group, charge_files):
+					print(f"Marked {len(group)} Charges imported.")
+					continue
+
+				# A failed group is retried one Charge at a time so only the Charges with bad files stay unimported
+				print(f"Batch failed, importing its Charges one at a time...")
+				for charge_id in group:
+					if store_csv_data(session, downloads_dir, charge_id, charge_files.get(charge_id)):
+						session.query(Charge).filter_by(id=charge_id).update({'imported': True})
+						clear_journal(session, [charge_id])
+						session.commit()
+			return
 
 		for charge in charges_to_import:
 			print(f"\nSearching for files related to Charge {charge.id}...")
-			# Search through subdirectories for CSV files containing the Charge's ID and process/import them to the DB (returns True if successful)
-			processed = store_csv_data(session, downloads_dir, charge.id)
+			# Process/import the Charge's CSV files to the DB (returns True if successful). Charges without manifest entries
+			# fall back to searching the subdirectories for CSV files containing the Charge's ID
+			processed = store_csv_data(session, downloads_dir, charge.id, charge_files.get(charge.id))
 			if processed:
 				print(f"Marking Charge {charge.id} imported.")
 				# Only mark charges as imported if the import process was successful
 				charge.imported = True
+				# the Charge is done, its journal is not needed anymore
+				clear_journal(session, [charge.id])
 				session.commit()
 			else:
 				# If the import process was unsuccessful, continue to the next Charge without marking it imported
@@ -151,6 +465,7 @@ if __name__ == '__main__':
 			if processed:
 				print(f"Marking Charge {charge.id} imported.")
 				charge.imported = True
+				clear_journal(session, [charge.id])
 				session.commit()
 			else:
 				continue
@@ -0,0 +1,101 @@
+import os
+import sys
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(parentdir)
+
+from datetime import datetime
+from sqlalchemy import delete
+from data_import.models import ScrapeJournal
+from data_import.bulk_ops import chunked
+
+# status of a tab in the scrape journal
+# exported: its CSV was downloaded (file_path), no data: the tab had no results, stored: its rows were read from the
+# DOM and stored, imported: its CSV was imported, failed: scraping it failed (attempts times so far)
+tab_exported = "exported"
+tab_empty = "no data"
+tab_stored = "stored"
+tab_imported = "imported"
+tab_failed = "failed"
+
+# failed scrapes of a tab after which it is given up on, so a tab that always fails does not keep its Charge unpulled
+max_tab_attempts = 3
+
+
+# Record that a tab of a Charge is done, as soon as it is. A Charge keeps one entry per tab, the latest status wins.
+# commit=False leaves the entry to be committed together with the tab's data
+def record_tab(session, charge, tab, status, file_path=None, commit=True):
+	try:
+		entry = session.query(ScrapeJournal).filter_by(charge_number=charge, tab=tab).first()
+		if not entry:
+			entry = ScrapeJournal(charge_number=charge, tab=tab)
+			session.add(entry)
+
+		entry.status = status
+		entry.file_path = file_path
+		entry.attempts = 0
+		entry.last_error = None
+		entry.updated_at = datetime.now()
+		if commit:
+			session.commit()
+		return entry
+	except Exception as e:
+		if commit:
+			session.rollback()
+		print(f"		! Error recording tab {tab} of Charge {charge} in the journal: {e}")
+		return None
+
+
+# Record a failed scrape of a tab of a Charge, counting the attempts like the Attachment retry queue. Once a tab failed
+# max_tab_attempts times it is given up on (see get_abandoned_tabs). Returns the entry, None if it could not be saved
+def record_tab_failure(session, charge, tab, error):
+	try:
+		entry = session.query(ScrapeJournal).filter_by(charge_number=charge, tab=tab).first()
+		if not entry:
+			entry = ScrapeJournal(charge_number=charge, tab=tab, attempts=0)
+			session.add(entry)
+
+		entry.status = tab_failed
+		entry.file_path = None
+		entry.attempts = (entry.attempts or 0) + 1
+		entry.last_error = str(error)[:500]
+		entry.updated_at = datetime.now()
+		session.commit()
+		return entry
+	except Exception as e:
+		session.rollback()
+		print(f"		! Error recording the failure of tab {tab} of Charge {charge} in the journal: {e}")
+		return None
+
+
+# Get the journal of a Charge as {tab: ScrapeJournal}
+def get_tab_journal(session, charge):
+	return {entry.tab: entry for entry in session.query(ScrapeJournal).filter_by(charge_number=charge)}
+
+
+# Tabs of a Charge that do not have to be scraped again: every journaled tab, except exports whose file is gone and
+# failed tabs that have attempts left
+def get_scraped_tabs(session, charge):
+	scraped_tabs = set()
+	for tab, entry in get_tab_journal(session, charge).items():
+		if entry.status == tab_exported and not (entry.file_path and os.path.exists(entry.file_path)):
+			continue
+		if entry.status == tab_failed and entry.attempts < max_tab_attempts:
+			continue
+		scraped_tabs.add(tab)
+	return scraped_tabs
+
+
+# Tabs of a Charge given up on after max_tab_attempts failed scrapes, as {tab: ScrapeJournal}
+def get_abandoned_tabs(session, charge):
+	return {
+		tab: entry for tab, entry in get_tab_journal(session, charge).items()
+		if entry.status == tab_failed and entry.attempts >= max_tab_attempts
+	}
+
+
+# Drop the journal of Charges that were fully imported or reset to be scraped again. Does not commit
+def clear_journal(session, charges):
+	for charge_chunk in chunked(list(charges), 1000):
+		session.execute(delete(ScrapeJournal).where(ScrapeJournal.charge_number.in_(charge_chunk)))
@@ -8,7 +8,7 @@ sys.path.append(parentdir)
 
 import re
 import pandas as pd
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, text, Integer, Float, String
 from sqlalchemy.orm import sessionmaker
 from data_import.models import (
 	Base,
@@ -80,6 +80,140 @@ def normalize_column_name(column_name):
 	return column_name.lower().strip("_")  # Strip leading or trailing underscores if any
 
 
+# CSV columns that map to a model field with a different name
+column_aliases = {
+	"Charge": {"charge_number": "id"},
+}
+
+# dtypes read_csv is slow to parse, read as another dtype and cast afterwards: the C parser has a fast path for floats
+# but parses nullable integers through python objects
+read_dtypes = {"Int32": "float64"}
+
+# whitespace only values read as empty in number columns (prepare_records treats them as empty in any column)
+blank_values = [" ", "  "]
+
+# import plans already built in this run, keyed by (model name, CSV headers)
+import_plans = {}
+
+
+# pandas dtype of the data frame column for a model field. Integer fields are 32 bit in the DB so they end up as the
+# nullable Int32 (empty values do not turn them into floats), text is kept as categories: the exports repeat the same
+# statuses, names and codes on most rows and each distinct string is only stored once. Dates are left as the strings
+# pandas reads, prepare_records parses them. Returns None when pandas should infer the column
+def column_dtype(column):
+	if isinstance(column.type, Integer):
+		return "Int32"
+	if isinstance(column.type, Float):
+		return "float64"
+	if isinstance(column.type, String):
+		return "category"
+	return None
+
+
+# How the columns of a CSV map onto a model's fields. Built once per model and header signature by get_import_plan
+# positions: index of every CSV column that is imported, fields: the model field each of those columns goes to,
+# unknown_columns: CSV columns the model has no field for (left out of the import),
+# usecols/dtypes/na_values: the headers to read, their pandas dtypes and the extra values read as empty, for read_csv
+# casts: fields converted after reading (see read_dtype)
+class ImportPlan:
+	def __init__(self, model, headers):
+		aliases = column_aliases.get(model.__name__, {})
+		model_fields = {column.name for column in model.__table__.columns if column.name != 'id'}
+
+		fields_by_position = {}
+		self.unknown_columns = []
+		for position, header in enumerate(headers):
+			field = normalize_column_name(str(header))
+			field = aliases.get(field, field)
+			if field in model_fields or field in aliases.values():
+				# if two headers normalize to the same field the last one wins, like building a dict from the row
+				fields_by_position = {p: f for p, f in fields_by_position.items() if f != field}
+				fields_by_position[position] = field
+			else:
+				self.unknown_columns.append(header)
+
+		self.positions = list(fields_by_position.keys())
+		self.fields = list(fields_by_position.values())
+		self.usecols = [headers[position] for position in self.positions]
+		self.dtypes = {}
+		self.casts = {}
+		for position, field in fields_by_position.items():
+			dtype = column_dtype(model.__table__.columns[field])
+			if dtype in read_dtypes:
+				self.casts[field] = dtype
+				dtype = read_dtypes[dtype]
+			if dtype:
+				self.dtypes[headers[position]] = dtype
+		# blank cells in the exports are sometimes a space instead of nothing, which a number column cannot parse
+		self.na_values = {
+			header: blank_values for header, dtype in self.dtypes.items() if dtype != "category"
+		}
+
+	# select the imported columns of a data frame read with the plan's headers and rename them to the model's fields
+	def apply(self, df):
+		df = df.iloc[:, self.positions]
+		df.columns = self.fields
+		return df
+
+	# rename the columns of a data frame read with usecols=plan.usecols (already only the imported columns) and cast
+	# the columns that were read as a different dtype (typed=False for a frame read untyped, nothing to cast).
+	# Raises TypeError if a value does not fit (e.g. 1.5 in an Integer)
+	def apply_selected(self, df, typed=True):
+		df.columns = self.fields
+		if typed:
+			for field, dtype in self.casts.items():
+				df[field] = df[field].astype(dtype)
+		return df
+
+
+# Get the import plan of a model for a CSV's headers, building and caching it the first time that header signature
+# is seen. Unknown columns are reported once per signature instead of failing every row
+def get_import_plan(model, headers):
+	signature = (model.__name__, tuple(headers))
+	plan = import_plans.get(signature)
+	if plan is None:
+		plan = ImportPlan(model, headers)
+		import_plans[signature] = plan
+		if plan.unknown_columns:
+			print(f"        Ignoring CSV columns with no {model.__name__} field: {plan.unknown_columns}")
+	return plan
+
+
+# select and rename the columns of a CSV data frame to the model's fields using the cached import plan
+def apply_import_plan(df, model):
+	return get_import_plan(model, df.columns).apply(df)
+
+
+# Read a CSV for a model: only the columns the model has fields for are parsed, straight into the dtypes of those
+# fields, and renamed to the field names. Returns the data frame (or a reader when chunksize is passed in) and the plan.
+# csv_path can also be an in memory text buffer. typed=False parses without dtypes, used when a file has values that
+# do not fit the field type
+def read_import_csv(csv_path, model, typed=True, **kwargs):
+	headers = list(pd.read_csv(csv_path, nrows=0).columns)
+	if hasattr(csv_path, 'seek'):
+		# rewind the buffer after reading the headers
+		csv_path.seek(0)
+	plan = get_import_plan(model, headers)
+	if not typed:
+		return pd.read_csv(csv_path, usecols=plan.usecols, **kwargs), plan
+	return pd.read_csv(csv_path, usecols=plan.usecols, dtype=plan.dtypes, na_values=plan.na_values, **kwargs), plan
+
+
+# Read a whole CSV for a model with read_import_csv, retrying without dtypes if a value does not fit its field's type
+# (e.g. text in an Integer column), which is what the ORM would have to cope with anyway
+def load_import_csv(csv_path, model):
+	try:
+		df, plan = read_import_csv(csv_path, model)
+		return plan.apply_selected(df)
+	except (ValueError, TypeError) as e:
+		name = os.path.basename(csv_path) if isinstance(csv_path, str) else "rows"
+		print(f"        Could not parse {name} with the {model.__name__} types ({e}), reading it untyped...")
+		if hasattr(csv_path, 'seek'):
+			csv_path.seek(0)
+		df, plan = read_import_csv(csv_path, model, typed=False)
+		return plan.apply_selected(df, typed=False)
+
+
 # convert CSV dates to valid format for fields with Date or Datetime types
 def convert_to_datetime(value, date_format="%m/%d/%Y %I:%M:%S %p"):
 	if pd.isnull(value) or not isinstance(value, str):
@@ -96,3 +230,58 @@ def convert_to_datetime(value, date_format="%m/%d/%Y %I:%M:%S %p"):
 			print(f"Failed to convert {value} to datetime")
 			return None
 
+
+# convert a whole column of CSV dates at once. Follows convert_to_datetime: only strings are converted, the datetime
+# format is tried first and then the date only format. Each distinct value is parsed once (exports repeat the same
+# timestamps a lot) and values neither vectorized pass could parse go through convert_to_datetime itself so edge
+# cases are handled the same way
+def convert_column_to_datetime(column, date_format="%m/%d/%Y %I:%M:%S %p"):
+	converted = pd.Series(None, index=column.index, dtype=object)
+	if column.dtype != object:
+		# a column pandas parsed as numbers (or all empty) has no strings to convert
+		return converted
+
+	text_values = column[column.map(lambda value: isinstance(value, str))]
+	if text_values.empty:
+		return converted
+
+	unique_values = pd.Series(text_values.unique())
+	parsed = pd.to_datetime(unique_values, format=date_format, errors='coerce')
+	missing = parsed.isna()
+	if missing.any():
+		parsed[missing] = pd.to_datetime(unique_values[missing], format="%m/%d/%Y", errors='coerce')
+
+	valid = parsed.notna()
+	# hand back plain datetimes like strptime does, DB drivers do not all accept pandas Timestamps
+	lookup = dict(zip(unique_values[valid], parsed[valid].to_numpy(dtype='datetime64[us]').tolist()))
+	for value in unique_values[~valid]:
+		lookup[value] = convert_to_datetime(value, date_format)
+
+	converted[text_values.index] = [lookup[value] for value in text_values]
+	return converted
+
+
+# Prepare a CSV data frame for inserting, one column at a time: parse the passed in date fields, then turn null and
+# blank values into None. Returns a list of dictionaries (one per row) keyed by column name
+def prepare_records(df, datetime_fields=()):
+	datetime_fields = [field for field in datetime_fields if field in df.columns]
+	# only columns pandas read as text (or text categories, see read_import_csv) can hold blank strings
+	text_columns = [
+		column for column in df.columns
+		if (df[column].dtype == object or isinstance(df[column].dtype, pd.CategoricalDtype))
+		and column not in datetime_fields
+	]
+
+	df = df.astype(object)
+	for field in datetime_fields:
+		df[field] = convert_column_to_datetime(df[field])
+
+	empty = df.isna()
+	for column in text_columns:
+		# whitespace only strings count as empty, .str gives NaN for the null values which compares as False
+		empty[column] |= df[column].str.strip().eq('')
+	df = df.where(~empty, None)
+	# the frame only holds python objects at this point, zipping the raw rows is much faster than to_dict
+	columns = list(df.columns)
+	return [dict(zip(columns, row)) for row in df.to_numpy().tolist()]
+
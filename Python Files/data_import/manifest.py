@@ -0,0 +1,85 @@
+import os
+import sys
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(parentdir)
+
+import hashlib
+from datetime import datetime
+from data_import.models import DownloadManifest, Charge
+
+# tab name used in the manifest for the monthly Charges exports
+charge_files_tab = "charge_files"
+
+
+# SHA-256 of a file, read in blocks so large exports are not loaded into memory
+def file_sha256(file_path, block_size=1024 * 1024):
+	digest = hashlib.sha256()
+	with open(file_path, 'rb') as file:
+		for block in iter(lambda: file.read(block_size), b''):
+			digest.update(block)
+	return digest.hexdigest()
+
+
+# Record a finished download in the manifest. Called by the scraper right after the file is renamed to its final
+# name. A Charge/Calendar only keeps one entry per tab, a new download of the same tab replaces the previous entry
+def record_download(session, tab, file_path, charge_number=None, calendar_id=None):
+	try:
+		entry = session.query(DownloadManifest).filter_by(
+			tab=tab,
+			charge_number=charge_number,
+			calendar_id=calendar_id
+		).first()
+		if not entry:
+			entry = DownloadManifest(tab=tab, charge_number=charge_number, calendar_id=calendar_id)
+			session.add(entry)
+
+		entry.file_path = file_path
+		entry.file_size = os.path.getsize(file_path)
+		entry.sha256 = file_sha256(file_path)
+		entry.downloaded_at = datetime.now()
+		session.commit()
+		return entry
+	except Exception as e:
+		session.rollback()
+		print(f"		! Error recording download of {file_path} in the manifest: {e}")
+		return None
+
+
+# Get the Charges file downloaded for a Calendar from the manifest. Returns None if it was never recorded or the file
+# has been moved or deleted since
+def get_calendar_file(session, calendar):
+	entry = session.query(DownloadManifest).filter_by(
+		tab=charge_files_tab,
+		calendar_id=calendar.id
+	).order_by(DownloadManifest.downloaded_at.desc()).first()
+	if entry and not os.path.exists(entry.file_path):
+		print(f"Recorded file {entry.file_path} no longer exists")
+		return None
+	return entry.file_path if entry else None
+
+
+# Get the downloaded tab files of every pulled and unimported Charge in one query.
+# Returns a dictionary of {charge number: {tab: file path}}
+def get_unimported_charge_files(session):
+	entries = session.query(DownloadManifest).join(Charge, DownloadManifest.charge_number == Charge.id).filter(
+		Charge.pulled == True,
+		Charge.imported == False,
+		DownloadManifest.tab != charge_files_tab
+	).all()
+
+	files = {}
+	for entry in entries:
+		files.setdefault(entry.charge_number, {})[entry.tab] = entry.file_path
+	return files
+
+
+# Get the downloaded tab files of one Charge. Returns {tab: file path}, None when nothing was recorded for it (like
+# get_unimported_charge_files(session).get(charge))
+def get_charge_files(session, charge):
+	entries = session.query(DownloadManifest).filter(
+		DownloadManifest.charge_number == charge,
+		DownloadManifest.tab != charge_files_tab
+	).all()
+	return {entry.tab: entry.file_path for entry in entries} or None
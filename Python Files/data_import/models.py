@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Date, Boolean
+from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Date, Boolean, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql import func
@@ -16,6 +16,8 @@ class Calendar(Base):
 	end_date = Column(Date, nullable=False)
 	pulled = Column(Boolean, default=False, nullable=False)
 	imported = Column(Boolean, default=False, nullable=False)
+	# when the month's Charges were last exported, incremental runs only re-export it once this is older than the TTL
+	last_pulled_at = Column(DateTime, nullable=True)
 
 	charges = relationship("Charge", back_populates='calendar')
 
@@ -50,6 +52,7 @@ class Charge(Base):
 	trouble_user_def2 = Column(String(200), nullable=True)
 	po_asn_count = Column(Integer, nullable=True)
 	parent_company = Column(String(150), nullable=True)
+	row_hash = Column(String(64), nullable=True)  # fingerprint of the CSV row the Charge was last imported from
 	created_at = Column(DateTime(timezone=True), server_default=func.now())
 	pulled = Column(Boolean, default=False, nullable=False)
 	imported = Column(Boolean, default=False, nullable=False)
@@ -324,6 +327,13 @@ class Attachment(Base):
 	link = Column(String(500), nullable=False)
 	downloaded = Column(Boolean, default=False, nullable=False)
 	file_path = Column(String(500), nullable=True)
+	# SHA-256 and size of the file in the content addressed attachment store (see csv_scraper.save_data_url)
+	sha256 = Column(String(64), nullable=True, index=True)
+	file_size = Column(Integer, nullable=True)
+	# retry queue of the attachment fetcher: failed fetches so far, the last error and when to try again
+	attempts = Column(Integer, default=0, nullable=False, server_default='0')
+	last_error = Column(String(500), nullable=True)
+	next_attempt_at = Column(DateTime, nullable=True)
 	charge_number = Column(Integer, ForeignKey('charge.id'))
 	document_id = Column(Integer, ForeignKey('document.id'))
 	report_id = Column(Integer, ForeignKey('report.id'))
@@ -333,4 +343,63 @@ class Attachment(Base):
 	report = relationship("Report", back_populates='attachments')
 
 	def __repr__(self):
-		return f"<Attachment(filename={self.filename}, downloaded={self.downloaded})>"
\ No newline at end of file
+		return f"<Attachment(filename={self.filename}, downloaded={self.downloaded})>"
+
+
+class ImportCheckpoint(Base):
+	__tablename__ = 'import_checkpoint'
+
+	id = Column(Integer, primary_key=True, autoincrement=True)
+	file_name = Column(String(255), nullable=False)
+	file_size = Column(Integer, nullable=False)
+	file_modified = Column(DateTime, nullable=False)
+	last_row = Column(Integer, default=0, nullable=False)  # number of data rows committed so far
+	completed = Column(Boolean, default=False, nullable=False)
+	updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+	calendar_id = Column(Integer, ForeignKey('calendar.id'))
+
+	calendar = relationship("Calendar")
+
+	def __repr__(self):
+		return f"<ImportCheckpoint(file_name={self.file_name}, last_row={self.last_row}, completed={self.completed})>"
+
+
+class DownloadManifest(Base):
+	__tablename__ = 'download_manifest'
+
+	id = Column(Integer, primary_key=True, autoincrement=True)
+	tab = Column(String(120), nullable=False)  # tab subdirectory name, 'charge_files' for monthly Charges exports
+	file_path = Column(String(500), nullable=False)
+	file_size = Column(Integer, nullable=True)
+	sha256 = Column(String(64), nullable=True)
+	downloaded_at = Column(DateTime(timezone=True), server_default=func.now())
+	charge_number = Column(Integer, ForeignKey('charge.id'), nullable=True)
+	calendar_id = Column(Integer, ForeignKey('calendar.id'), nullable=True)
+
+	__table_args__ = (
+		Index('ix_download_manifest_charge_number_tab', 'charge_number', 'tab'),
+		Index('ix_download_manifest_calendar_id_tab', 'calendar_id', 'tab'),
+	)
+
+	def __repr__(self):
+		return f"<DownloadManifest(tab={self.tab}, charge_number={self.charge_number}, calendar_id={self.calendar_id})>"
+
+
+class ScrapeJournal(Base):
+	__tablename__ = 'scrape_journal'
+
+	id = Column(Integer, primary_key=True, autoincrement=True)
+	charge_number = Column(Integer, ForeignKey('charge.id'), nullable=False)
+	tab = Column(String(120), nullable=False)  # tab subdirectory name, like DownloadManifest.tab
+	status = Column(String(20), nullable=False)  # see data_import.journal
+	file_path = Column(String(500), nullable=True)
+	attempts = Column(Integer, default=0, nullable=False, server_default='0')  # failed scrapes since the tab was done
+	last_error = Column(String(500), nullable=True)
+	updated_at = Column(DateTime(timezone=True), server_default=func.now())
+
+	__table_args__ = (
+		Index('ix_scrape_journal_charge_number_tab', 'charge_number', 'tab', unique=True),
+	)
+
+	def __repr__(self):
+		return f"<ScrapeJournal(charge_number={self.charge_number}, tab={self.tab}, status={self.status})>"
@@ -20,6 +20,19 @@ from datetime import datetime
 import re
 import getpass
 import base64
+import shutil
+import json
+import threading
+import hashlib
+import tempfile
+import csv
+from collections import namedtuple
+from contextlib import contextmanager
+from data_import.manifest import record_download, charge_files_tab
+from data_import.journal import (
+	record_tab, record_tab_failure, get_scraped_tabs, get_abandoned_tabs, max_tab_attempts, tab_exported, tab_empty,
+	tab_stored
+)
 
 # Directory where exported CSVs will be saved -- will contain sub-folders representing each tab
 # downloads_dir = os.path.join(os.getcwd(), "downloads")
@@ -29,37 +42,478 @@ combined_dir = os.path.join(os.getcwd(), "combined_files")
 
 timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
 
+# Warm start (setup_driver(warm=True)): Chrome profile kept between runs so the portal's cookies and the browser cache
+# survive, and the file remembering the chromedriver webdriver_manager last installed. Both are kept in the user's
+# local cache directory, out of the repo and out of the synced downloads folder
+cache_dir = os.path.join(os.environ.get('LOCALAPPDATA', os.path.join(os.path.expanduser('~'), '.cache')), 'Kohls Program')
+profile_dir = os.path.join(cache_dir, "chrome_profile")
+driver_path_file = os.path.join(cache_dir, "chromedriver_path.txt")
+
+# Requests the scraping profile blocks (setup_driver(block_assets=True)): images and fonts the portal's pages load but
+# the scraper never reads. Stylesheets are kept, the waits check elements are visible/clickable which depends on them
+blocked_url_patterns = [
+	"*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.svg", "*.ico",
+	"*.woff", "*.woff2", "*.ttf", "*.otf", "*.eot",
+	"*fonts.googleapis.com*", "*fonts.gstatic.com*",
+]
+
+# origin of the portal's single page app, its pages are hash routes (#/...) of this one document
+portal_origin = "https://kss.traversesystems.com"
+
+# full XPath of a Charge page's tab container, holding the tab list and the tab panes
+tab_container_xpath = '/html/body/router-view/main-layout/div/main/div/div[2]/tab-container'
+# full XPath of a Charge page's tab pane by index (starts at 1), the tab's content is shown/hidden inside it
+tab_pane_xpath = '/html/body/router-view/main-layout/div/main/div/div[2]/tab-container/div/div[2]/div/div/div/div[{index}]'
+
+
+# Records how long each kind of wait in the scraper took (and how many timed out) so timeouts can be set from what
+# the portal actually needs. Shared by every thread of a run, print_report shows p50/p95/max per kind
+class WaitTimer:
+	def __init__(self):
+		self.durations = {}
+		self.timeouts = {}
+		self.lock = threading.Lock()
+
+	@contextmanager
+	def time(self, kind):
+		start_time = time.perf_counter()
+		try:
+			yield
+		except TimeoutException:
+			with self.lock:
+				self.timeouts[kind] = self.timeouts.get(kind, 0) + 1
+			raise
+		finally:
+			self.record(kind, time.perf_counter() - start_time)
+
+	# add a duration measured elsewhere (e.g. startup, see report_startup)
+	def record(self, kind, elapsed):
+		with self.lock:
+			self.durations.setdefault(kind, []).append(elapsed)
+
+	@staticmethod
+	def percentile(values, percent):
+		# nearest rank
+		ordered = sorted(values)
+		return ordered[max(0, min(len(ordered) - 1, round(percent / 100 * len(ordered)) - 1))]
+
+	def print_report(self):
+		if not self.durations:
+			return
+		print(f"\n{'Wait':<22}{'Count':>8}{'p50 (s)':>10}{'p95 (s)':>10}{'Max (s)':>10}{'Timeouts':>10}")
+		for kind, durations in sorted(self.durations.items()):
+			print(
+				f"{kind:<22}{len(durations):>8}{self.percentile(durations, 50):>10.2f}"
+				f"{self.percentile(durations, 95):>10.2f}{max(durations):>10.2f}{self.timeouts.get(kind, 0):>10}"
+			)
+
+	def reset(self):
+		with self.lock:
+			self.durations = {}
+			self.timeouts = {}
+
 
-def setup_driver():
+wait_timer = WaitTimer()
+
+
+# Path of the chromedriver to start. webdriver_manager checks the installed Chrome's version and the latest driver
+# over the network on every call, with cached=True the driver it installed last time is used as long as it is still
+# on disk. Falls back to the last driver when the check fails (e.g. offline)
+def resolve_driver_path(cached=False):
+	cached_path = None
+	if os.path.exists(driver_path_file):
+		with open(driver_path_file) as file:
+			cached_path = file.read().strip()
+		if not os.path.exists(cached_path):
+			cached_path = None
+	if cached and cached_path:
+		return cached_path
+
+	try:
+		driver_path = ChromeDriverManager().install()
+	except Exception as e:
+		if not cached_path:
+			raise
+		print(f"Could not check for a new chromedriver ({e}), using {cached_path}")
+		return cached_path
+	os.makedirs(os.path.dirname(driver_path_file), exist_ok=True)
+	with open(driver_path_file, 'w') as file:
+		file.write(driver_path)
+	return driver_path
+
+
+# download_dir: where the browser saves downloads (each worker of a scraping pool gets its own)
+# headless: run Chrome without a window
+# warm: start from the cached chromedriver and the persistent Chrome profile in warm_profile_dir (one per browser,
+# Chrome locks a profile while it is open), and let login skip the form when the profile is still logged in.
+# The driver keeps its start time so the time to the first charge page can be reported (see report_startup)
+# block_assets: don't load the images and fonts in blocked_url_patterns. With headless=True this is the scraping
+# profile, see scrape_benchmark for how it compares to a full browser
+# downloads: the driver exports CSVs, turns on the performance log for the download events (see wait_for_download).
+# Drivers that only read pages (attachments, benchmarks) leave it off
+def setup_driver(
+	download_dir=downloads_dir, headless=False, warm=False, warm_profile_dir=profile_dir, block_assets=False,
+	downloads=True
+):
+	started_at = time.perf_counter()
 	options = Options()
+	if warm:
+		options.add_argument(f"--user-data-dir={warm_profile_dir}")
+	if headless:
+		options.add_argument("--headless=new")
+		# headless Chrome defaults to a small window, the portal's tables collapse at that size
+		options.add_argument("--window-size=1920,1080")
 	options.add_experimental_option("prefs", {
-		"download.default_directory": downloads_dir,
+		"download.default_directory": download_dir,
 		"download.prompt_for_download": False,
 		"download.directory_upgrade": True,
 		"safebrowsing.enabled": True
 	})
-	setup_service = Service(ChromeDriverManager().install())
+	if downloads:
+		# performance logging is how the CDP download events reach wait_for_download
+		options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+	setup_service = Service(resolve_driver_path(cached=warm))
 
 	web_driver = webdriver.Chrome(service=setup_service, options=options)
+	web_driver.download_events = False
+	if downloads:
+		enable_download_events(web_driver, download_dir)
+	if block_assets:
+		set_asset_blocking(web_driver, True)
+	web_driver.warm_start = warm
+	web_driver.started_at = started_at
+	wait_timer.record("driver startup", time.perf_counter() - started_at)
 	return web_driver
 
 
+# Turn the blocking of blocked_url_patterns on or off for a driver, e.g. off before viewing attachments which may be
+# images. Blocked requests fail in the browser like an unreachable URL, the page's scripts carry on without them
+def set_asset_blocking(driver, blocked):
+	try:
+		driver.execute_cdp_cmd("Network.enable", {})
+		driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": blocked_url_patterns if blocked else []})
+		driver.assets_blocked = blocked
+	except Exception as e:
+		print(f"Could not {'block' if blocked else 'unblock'} page assets: {e}")
+
+
+# Report how long the driver took from setup_driver to its first charge page (search or Charge), once per driver
+def report_startup(driver):
+	started_at = getattr(driver, 'started_at', None)
+	if started_at is None:
+		return
+	driver.started_at = None
+	elapsed = time.perf_counter() - started_at
+	wait_timer.record("startup to charges", elapsed)
+	print(f"First charge page reached {elapsed:.2f}s after starting the browser ({'warm' if driver.warm_start else 'cold'} start)")
+
+
 # Selenium's wait for element method abstracted with defaults
 # by=selector type - value=element's selector - condition=what to wait for - timeout=how long to wait
-def wait_for_element(driver, by, value, condition=EC.presence_of_element_located, timeout=30):
-	return WebDriverWait(driver, timeout).until(condition((by, value)))
+# kind=name the wait is timed under in the wait report (see WaitTimer), not timed when None
+def wait_for_element(driver, by, value, condition=EC.presence_of_element_located, timeout=30, kind=None):
+	if kind is None:
+		return WebDriverWait(driver, timeout).until(condition((by, value)))
+	with wait_timer.time(kind):
+		return WebDriverWait(driver, timeout).until(condition((by, value)))
 
 
-# used to change the driver's download location
+# wait for any expected condition (e.g. EC.url_contains(...)), timed under kind in the wait report
+def wait_until(driver, condition, kind, timeout=10):
+	with wait_timer.time(kind):
+		return WebDriverWait(driver, timeout).until(condition)
+
+
+# checks for wait_for_any outcomes
+def is_clickable(element):
+	return element.is_displayed() and element.is_enabled()
+
+
+def has_no_results_text(element):
+	return "No Results" in element.text
+
+
+# a tab's data-table is loaded: its body has rows and its 'export to csv' button can be clicked
+def tab_table_ready(element):
+	rows = element.find_elements(By.CSS_SELECTOR, 'table > tbody > tr')
+	export_buttons = element.find_elements(By.XPATH, './div[2]/div[2]/div/div/a[3]')
+	return bool(rows) and bool(export_buttons) and is_clickable(export_buttons[0])
+
+
+# Wait for whichever of several mutually exclusive page states shows up first (e.g. results table vs "No Results"
+# alert), so the happy path never sits out the timeout of the state that did not happen.
+# outcomes: {name: (locator, check)}, check(element) -> bool narrows down a matching element (None: present is enough).
+# Outcomes are checked in order on every poll, list the more specific one first when their elements can overlap.
+# Returns (name, element) of the first outcome seen, raises TimeoutException if none shows up within timeout
+def wait_for_any(driver, outcomes, timeout=10, kind=None):
+	def first_outcome(driver):
+		for name, (locator, check) in outcomes.items():
+			try:
+				for element in driver.find_elements(*locator):
+					if check is None or check(element):
+						return name, element
+			except StaleElementReferenceException:
+				# re-rendered while checking, look again on the next poll
+				continue
+		return False
+
+	if kind is None:
+		return WebDriverWait(driver, timeout).until(first_outcome)
+	return wait_until(driver, first_outcome, kind, timeout)
+
+
+# expected condition: an element is present and its attribute starts with prefix (e.g. an img whose base64 data URL
+# has been filled in). Returns the attribute's value
+def attribute_starts_with(locator, attribute, prefix):
+	def condition(driver):
+		try:
+			value = driver.find_element(*locator).get_attribute(attribute)
+		except (NoSuchElementException, StaleElementReferenceException):
+			return False
+		return value if value and value.startswith(prefix) else False
+	return condition
+
+
+# True when the page is the portal's app, bootstrapped (its layout is rendered) and not sitting on the login route,
+# i.e. a hash route change will be handled by the app's router
+app_loaded_script = """
+return location.origin === arguments[0] && !!document.querySelector('router-view main-layout') && !location.hash.startsWith('#/login');
+"""
+
+# True when the charge page's content outside its tab container (the charge's header) shows the charge number in
+# arguments[0], i.e. the page is the requested charge's and not the previous charge or a loading placeholder
+charge_shown_script = """
+const main = document.querySelector('router-view main-layout main');
+if (!main) { return false; }
+const number = new RegExp('(^|[^0-9])' + arguments[0] + '([^0-9]|$)');
+const walker = document.createTreeWalker(main, NodeFilter.SHOW_TEXT);
+while (walker.nextNode()) {
+	const node = walker.currentNode;
+	if (!node.parentElement.closest('tab-container') && number.test(node.textContent)) { return true; }
+}
+return false;
+"""
+
+# drop the data URLs of the attachment viewers on the page so a viewer still showing the previous attachment is never
+# read as the next one
+clear_viewers_script = """
+for (const viewer of document.querySelectorAll('iframe[src^="data:"], img[src^="data:"]')) { viewer.removeAttribute('src'); }
+"""
+
+
+# Switch the loaded app to url's hash route without reloading the page. Returns False without navigating when the
+# page is not the loaded app (blank tab, login, broken state), the caller then loads the page with reload_app
+def start_in_app_navigation(driver, url):
+	if '#' not in url:
+		return False
+	try:
+		if not driver.execute_script(app_loaded_script, portal_origin):
+			return False
+		driver.execute_script("window.location.hash = arguments[0];", url[url.index('#'):])
+		return True
+	except WebDriverException:
+		return False
+
+
+# Load url as a new document, bootstrapping the app again. driver.get alone does not reload when only the hash route
+# differs from the current URL
+def reload_app(driver, url):
+	driver.get(url)
+	driver.refresh()
+
+
+# Navigate to one of the app's routes, in place when the app is loaded and with a full reload otherwise.
+# rendered: wait condition telling when the route's view is on the page, waited for (timed under kind) after an in
+# place navigation. If it does not hold within timeout the app's state is taken as broken and the page is reloaded.
+# Returns True if the route was rendered in place, False if the page was reloaded (the caller waits for it as usual)
+def navigate_in_app(driver, url, rendered, kind, timeout=10):
+	if start_in_app_navigation(driver, url):
+		try:
+			wait_until(driver, lambda driver: url in driver.current_url and rendered(driver), kind, timeout)
+			return True
+		except TimeoutException:
+			print(f"		! The app did not render {url[url.index('#'):]} in place, reloading it")
+	reload_app(driver, url)
+	return False
+
+
+# the first element matching locator and its text, to tell later whether the view was rendered again (view_replaced)
+def view_snapshot(driver, locator):
+	try:
+		elements = driver.find_elements(*locator)
+		return (elements[0], elements[0].text) if elements else None
+	except StaleElementReferenceException:
+		return None
+
+
+# expected condition: the element matching locator is not the one of the snapshot taken before navigating (a new view
+# was rendered), or the app reused the element and its content changed. Returns the element
+def view_replaced(locator, snapshot):
+	def condition(driver):
+		elements = driver.find_elements(*locator)
+		if not elements:
+			return False
+		try:
+			if snapshot and elements[0] == snapshot[0] and elements[0].text == snapshot[1]:
+				return False
+		except StaleElementReferenceException:
+			return False
+		return elements[0]
+	return condition
+
+
+# expected condition: the charge page shows charge's number in its header (see charge_shown_script)
+def charge_shown(charge):
+	def condition(driver):
+		try:
+			return driver.execute_script(charge_shown_script, str(charge))
+		except WebDriverException:
+			return False
+	return condition
+
+
+# expected condition: both conditions hold at once. Returns the first condition's result
+def all_hold(*conditions):
+	def condition(driver):
+		result = conditions[0](driver)
+		return result if result and all(other(driver) for other in conditions[1:]) else False
+	return condition
+
+
+# used to change the driver's download location. With download events enabled (see enable_download_events) the
+# browser keeps reporting downloads and saves them under their GUID
 def set_download_directory(driver, new_directory):
+	driver.download_directory = new_directory
+	if getattr(driver, "download_events", False):
+		driver.execute_cdp_cmd("Browser.setDownloadBehavior", {
+			"behavior": "allowAndName",
+			"downloadPath": new_directory,
+			"eventsEnabled": True
+		})
+		return
 	driver.execute_cdp_cmd("Page.setDownloadBehavior", {
 		"behavior": "allow",
 		"downloadPath": new_directory
 	})
 
 
+# Have the browser report its downloads: every download is saved as <download directory>/<GUID> and its progress
+# events land in the performance log, where wait_for_download picks them up. Needs the driver to be created with the
+# 'goog:loggingPrefs' performance capability (see setup_driver), otherwise downloads keep being found by polling
+# the directory with wait_for_file
+def enable_download_events(driver, download_dir):
+	try:
+		driver.get_log("performance")
+		driver.download_events = True
+		set_download_directory(driver, download_dir)
+	except Exception as e:
+		driver.download_events = False
+		print(f"Download events not available, falling back to watching the download directory: {e}")
+
+
+# drop the performance log entries collected so far, called before starting a download so wait_for_download only sees
+# events of that download. The files already in the download directory are noted too, for when no events arrive
+def clear_download_events(driver):
+	if getattr(driver, "download_events", False):
+		driver.get_log("performance")
+		download_directory = getattr(driver, "download_directory", None)
+		driver.known_downloads = set(os.listdir(download_directory)) if download_directory and os.path.isdir(download_directory) else set()
+
+
+# Wait for the download started after the last clear_download_events to finish. The download is followed by its GUID
+# through the Browser/Page.downloadWillBegin and downloadProgress events, so the exact file of this export is returned
+# as soon as the browser reports it completed. The download directory is watched for the new (GUID named) file at the
+# same time, so a download whose events never arrive is still picked up as soon as it is finished.
+# Returns the file's path (<download_directory>/<GUID>, renamed by the caller), None if it was canceled or timed out.
+# Drivers without download events fall back to wait_for_file
+def wait_for_download(driver, download_directory, timeout=60, poll_interval=0.1):
+	with wait_timer.time("download"):
+		if not getattr(driver, "download_events", False):
+			return wait_for_file(download_directory, timeout)
+		return wait_for_download_events(driver, download_directory, timeout, poll_interval)
+
+
+# the download event part of wait_for_download
+def wait_for_download_events(driver, download_directory, timeout, poll_interval):
+	guid = None
+	new_file = new_file_watcher(download_directory, getattr(driver, "known_downloads", set()))
+	end_time = time.time() + timeout
+	while time.time() < end_time:
+		for entry in driver.get_log("performance"):
+			message = json.loads(entry["message"])["message"]
+			method = message.get("method", "")
+			if not method.endswith(("downloadWillBegin", "downloadProgress")):
+				continue
+
+			params = message.get("params", {})
+			if method.endswith("downloadWillBegin"):
+				# the first download to begin after the click is this export's
+				if guid is None:
+					guid = params["guid"]
+					print(f"	- Download started: {params.get('suggestedFilename')}")
+			elif params.get("guid") == guid:
+				if params.get("state") == "completed":
+					return os.path.join(download_directory, guid)
+				if params.get("state") == "canceled":
+					print(f"	- Download canceled")
+					return None
+
+		file_path = new_file()
+		if file_path:
+			if guid is None:
+				print(f"	- Download found in {download_directory} without download events")
+			return file_path
+		time.sleep(poll_interval)
+
+	return None
+
+
+# Watch download_directory for a file that is not in known_files to finish downloading, whatever its name (the
+# browser saves downloads under their GUID once download events are on). Chrome writes to a .crdownload file and
+# renames it when the download completed, a GUID named file may be written in place though, so its size also has to
+# stay the same for stable_for seconds. Returns a function that checks the directory once and returns the finished
+# file's path, None while there is none
+def new_file_watcher(download_directory, known_files, stable_for=1):
+	# {file: (size, time the size was first seen)}
+	sizes = {}
+
+	def check():
+		if not os.path.isdir(download_directory):
+			return None
+		for file in os.listdir(download_directory):
+			file_path = os.path.join(download_directory, file)
+			if file in known_files or file.endswith('.crdownload') or not os.path.isfile(file_path):
+				continue
+			size = os.path.getsize(file_path)
+			if file not in sizes or sizes[file][0] != size:
+				sizes[file] = (size, time.time())
+			elif size > 0 and time.time() - sizes[file][1] >= stable_for:
+				return file_path
+		return None
+	return check
+
+
 # fill login inputs and submit
+# Check whether the browser is still logged in to the portal (a warm start's profile keeps the session cookies):
+# the home page shows the main menu when it is, and redirects to the login form when it is not
+def is_logged_in(driver, timeout=10):
+	driver.get("https://kss.traversesystems.com/#/home")
+	try:
+		outcome, _ = wait_for_any(driver, {
+			"logged in": ((By.CSS_SELECTOR, 'a[href="#mm-item-2"]'), None),
+			"login form": ((By.ID, "username"), None),
+		}, timeout=timeout, kind="session check")
+	except TimeoutException:
+		return False
+	return outcome == "logged in"
+
+
 def login(driver):
+	# a warm started browser may still have a valid session, no need to fill the form again
+	if getattr(driver, 'warm_start', False) and is_logged_in(driver):
+		print("Already logged in, skipping login")
+		return
+
 	# Navigate to kohls login page
 	driver.get("https://kss.traversesystems.com/#/login")
 
@@ -76,7 +530,7 @@ def login(driver):
 	login_button.click()
 
 	# wait for the URL to contain the 'home' param to confirm successful login. (portal redirects to home after login)
-	WebDriverWait(driver, 10).until(EC.url_contains(f"home"))
+	wait_until(driver, EC.url_contains(f"home"), "login")
 
 
 # clicks 'Vendor Tools' menu, then clicks 'Find Charges'
@@ -91,6 +545,7 @@ def navigate_to_charges(driver):
 
 	# Wait for and grab container containing search inputs
 	search_container = wait_for_element(driver, By.XPATH, '/html/body/router-view/main-layout/div/main/div/div[2]/div[2]/control-container/div/div')
+	report_startup(driver)
 	try:
 		# Grab the element containing the collapse/expand icon
 		collapse_icon = wait_for_element(driver, By.XPATH, '/html/body/router-view/main-layout/div/main/div/div[2]/div[2]/control-container/div/ul/li/a/i', timeout=10)
@@ -131,23 +586,24 @@ def fill_search_criteria(driver, start, end):
 	wait_for_element(driver, By.CSS_SELECTOR, 'button.btn.btn-primary.btn-lg', EC.element_to_be_clickable).click()
 
 
-# export charges as CSV
-def export_charges_csv(driver, calendar):
+# export charges as CSV. When a DB session is passed in the downloaded file is recorded in the download manifest
+def export_charges_csv(driver, calendar, session=None):
 	try:
-		no_results = wait_for_element(driver, By.XPATH, "/html/body/router-view/main-layout/div/main/div/div[2]/div[2]/div[3]/div[2]/div/html/body/router-view/main-layout/div/main/div/div[2]/div[2]/div[3]/div[2]/div", timeout=2)
-		if no_results:
+		# Wait for the search to either show the 'Export to CSV' button of the results table or the "No Results" alert
+		outcome, button = wait_for_any(driver, {
+			"results": (
+				(By.XPATH, '/html/body/router-view/main-layout/div/main/div/div[2]/div[2]/div[3]/div[2]/div/data-table/div[2]/div[2]/div/div/a[3]'),
+				is_clickable
+			),
+			"no results": (
+				(By.XPATH, '/html/body/router-view/main-layout/div/main/div/div[2]/div[2]/div[3]/div[2]/div'),
+				has_no_results_text
+			),
+		}, timeout=30, kind="search results")
+		if outcome == "no results":
 			print(f"No results for {calendar.month}-{calendar.year}, skipping...")
 			return False
-	except Exception as e:
-		pass
-	try:
-		# Wait for and grab the 'Export to CSV' button
-		button = wait_for_element(
-			driver,
-			By.XPATH,
-			'/html/body/router-view/main-layout/div/main/div/div[2]/div[2]/div[3]/div[2]/div/data-table/div[2]/div[2]/div/div/a[3]',
-			EC.element_to_be_clickable
-		)
+
 		# locate/create subdirectory within 'downloads' to store charges CSV
 		charge_directory = os.path.join(downloads_dir, "charge_files")
 		if not os.path.exists(charge_directory):
@@ -156,13 +612,14 @@ def export_charges_csv(driver, calendar):
 		# change driver's download directory to charge_directory before clicking button (downloads/charge_files)
 		set_download_directory(driver, charge_directory)
 
+		clear_download_events(driver)
 		# click the 'export to csv' button that will download the CSV
 		button.click()
 	except Exception as e:
 		return False
 
 	# wait for the file to download
-	downloaded_file = wait_for_file(charge_directory,timeout=15)
+	downloaded_file = wait_for_download(driver, charge_directory, timeout=15)
 	if downloaded_file:
 		# Rename downloaded file to contain Calendar info used to scrape this Charge
 		new_filename = os.path.join(
@@ -176,6 +633,8 @@ def export_charges_csv(driver, calendar):
 		# Rename the downloaded file
 		os.rename(downloaded_file, new_filename)
 		print(f"File renamed to: {new_filename}")
+		if session is not None:
+			record_download(session, charge_files_tab, new_filename, calendar_id=calendar.id)
 		return True
 	else:
 		print(f"Download failed or file not found")
@@ -230,30 +689,141 @@ def extract_charges_from_csv(file):
 
 
 # navigates to charge page using URL params and run the scraping process on that Charge page
-def scrape_charge_data(driver, session, charge, Attachment):
+# staging_dir: see export_related_csvs
+# on_tab_rows/persist_csv: see export_related_csvs
+def scrape_charge_data(driver, session, charge, Attachment, staging_dir=None, on_tab_rows=None, persist_csv=False):
 	# place charge number in URL param
-	url = f"https://kss.traversesystems.com/#/inquiry/charge?keyNum={charge}"
-	# navigate to URL
-	driver.get(url)
-	time.sleep(0.5)
-	# wait until URL contains the param before continuing
-	WebDriverWait(driver, 10).until(EC.url_contains(f"keyNum={charge}"))
+	url = f"{portal_origin}/#/inquiry/charge?keyNum={charge}"
+	# switch the loaded app to the Charge's route and wait for its tab container to be rendered again with the Charge's
+	# number in the page's header (a re-render of the previous Charge or a loading placeholder does not count), the
+	# page is only reloaded when that does not work
+	tab_container = (By.XPATH, tab_container_xpath)
+	rendered = all_hold(view_replaced(tab_container, view_snapshot(driver, tab_container)), charge_shown(charge))
+	if not navigate_in_app(driver, url, rendered, "charge navigation"):
+		# wait until URL contains the param and the page shows the Charge before continuing (export_related_csvs then
+		# waits for the tabs to render)
+		try:
+			wait_until(driver, EC.url_contains(f"keyNum={charge}"), "charge navigation")
+			wait_until(driver, charge_shown(charge), "charge shown", 30)
+		except TimeoutException:
+			print(f"Charge {charge} was not shown after loading its page")
+			return False
+	report_startup(driver)
 	# run function to click on and extract related tabs for current charge and return its result (True/False)
-	return export_related_csvs(driver, session, charge, Attachment)
+	return export_related_csvs(
+		driver, session, charge, Attachment, staging_dir=staging_dir, on_tab_rows=on_tab_rows, persist_csv=persist_csv
+	)
+
+
+# Read a data-table's header and rows straight from the DOM in one execute_script call. Returns a dictionary with the
+# column 'headers', the 'rows' (lists of cell texts, only rows with a cell per header), the number of body rows
+# ('row_count', a half rendered row has fewer cells than headers), the row 'total' the table's pager/info text reports
+# ('1-25 of 40', '40 records', null when it shows none) and whether the table is 'paginated' (an enabled next page
+# control, meaning the DOM only holds the first page)
+extract_table_script = """
+const dataTable = document.evaluate(arguments[0], document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+if (!dataTable) { return null; }
+const table = dataTable.querySelector('table');
+if (!table) { return null; }
+const headers = Array.from(table.querySelectorAll('thead th')).map(cell => cell.innerText.trim());
+const rows = [];
+const bodyRows = table.querySelectorAll('tbody > tr');
+for (const row of bodyRows) {
+	const cells = Array.from(row.querySelectorAll('td')).map(cell => cell.innerText.trim());
+	if (cells.length === headers.length) { rows.push(cells); }
+}
+let total = null;
+const walker = document.createTreeWalker(dataTable, NodeFilter.SHOW_TEXT);
+while (walker.nextNode() && total === null) {
+	if (table.contains(walker.currentNode)) { continue; }
+	const match = walker.currentNode.textContent.match(/\\bof\\s+([0-9,]+)|([0-9,]+)\\s+(?:total|records|items|results|entries|rows)/i);
+	if (match) { total = parseInt((match[1] || match[2]).replace(/,/g, ''), 10); }
+}
+const paginated = Array.from(dataTable.querySelectorAll('.pagination li:not(.disabled) a, .pagination li:not(.disabled) button'))
+	.some(control => /next|›|»/i.test(control.innerText + ' ' + (control.getAttribute('aria-label') || '')));
+return {headers: headers, rows: rows, row_count: bodyRows.length, total: total, paginated: paginated};
+"""
+
+
+def extract_table_rows(driver, data_table_xpath):
+	with wait_timer.time("table extraction"):
+		return driver.execute_script(extract_table_script, data_table_xpath)
+
+
+# Whether rows read with extract_table_rows are the whole table: not paginated, at least one row, every body row read
+# and as many rows as the table's total (when it shows one). Anything else is exported as a CSV instead
+def table_complete(table):
+	if not table or table['paginated'] or not table['rows']:
+		return False
+	if len(table['rows']) != table.get('row_count', len(table['rows'])):
+		return False
+	return table.get('total') is None or table['total'] == len(table['rows'])
+
+
+# Write rows read from the DOM to a tab's CSV (named like the exported files) and record it in the download manifest,
+# used to keep an audit copy of in-DOM extractions. Returns the file path
+def save_tab_rows(session, tab_name, charge, headers, rows):
+	tab_directory = os.path.join(downloads_dir, tab_name)
+	if not os.path.exists(tab_directory):
+		os.makedirs(tab_directory)
+	file_path = os.path.join(tab_directory, f"{tab_name}_{charge}.csv")
+	with open(file_path, 'w', newline='') as file:
+		writer = csv.writer(file)
+		writer.writerow(headers)
+		writer.writerows(rows)
+	record_download(session, tab_name, file_path, charge_number=charge)
+	return file_path
 
 
 # click on tabs within a charge and extract the data as CSV
-def export_related_csvs(driver, session, charge, Attachment, retries=2):
+# staging_dir: directory the browser downloads into before the file is moved to its tab's subdirectory. Used when
+# several browsers scrape at once so that one browser never picks up another's download. When not passed in, the
+# browser downloads straight into the tab's subdirectory
+# on_tab_rows: when passed in, the tab's rows are read from the DOM (extract_table_rows) and handed to
+# on_tab_rows(charge, tab name, headers, rows) instead of exporting a CSV, e.g. to import them right away. A tab whose
+# table is paginated is still exported. persist_csv=True also saves the extracted rows as the tab's CSV for auditing
+# Every finished tab is recorded in the scrape journal (data_import.journal) and tabs already journaled are skipped,
+# so a Charge that failed part way resumes at the tab it stopped on. Failed tabs are journaled with their attempts, a
+# tab that failed max_tab_attempts times is given up on and reported. Returns True once every tab is done or given up
+def export_related_csvs(driver, session, charge, Attachment, retries=2, staging_dir=None, on_tab_rows=None, persist_csv=False):
 	try:
 		# Wait for the tabs list containing the related data to be present
-		tabs_list = wait_for_element(driver, By.XPATH, '/html/body/router-view/main-layout/div/main/div/div[2]/tab-container/div/div[2]/div/ul')
+		tabs_list = wait_for_element(driver, By.XPATH, '/html/body/router-view/main-layout/div/main/div/div[2]/tab-container/div/div[2]/div/ul', kind="tabs rendered")
 		# Grab the list of tabs
 		tabs = tabs_list.find_elements(By.CSS_SELECTOR, 'a.au-target')
 		total_tabs = len(tabs)
 
 		print(f"\nProcessing charge: {charge} | Total tabs found: {total_tabs}\n")
 
+		scraped_tabs = get_scraped_tabs(session, charge)
+		abandoned_tabs = list(get_abandoned_tabs(session, charge))
+		failed_tabs = []
+
+		# journal a failed tab, it is given up on once it is out of attempts
+		def tab_failed(tab_subdir, error):
+			entry = record_tab_failure(session, charge, tab_subdir, error)
+			if entry is not None and entry.attempts >= max_tab_attempts:
+				abandoned_tabs.append(tab_subdir)
+			else:
+				failed_tabs.append(tab_subdir)
+
+		# hand a tab's rows to on_tab_rows and journal the tab as stored, committed together with the rows. A DB error
+		# only fails this tab. Returns True if the rows were stored
+		def store_rows(tab_subdir, headers, rows, file_path):
+			try:
+				on_tab_rows(charge, tab_subdir, headers, rows)
+			except Exception as e:
+				session.rollback()
+				print(f"		! Error storing the rows of tab '{tab_subdir}' for charge '{charge}': {e}")
+				tab_failed(tab_subdir, e)
+				return False
+			if record_tab(session, charge, tab_subdir, tab_stored, file_path) is None:
+				tab_failed(tab_subdir, "the rows could not be committed")
+				return False
+			return True
+
 		for index, tab in enumerate(tabs):
+			tab_name = tab_subdir = None
 			try:
 				# Re-locate the tabs in each loop iteration to avoid stale element issues
 				tabs_list = wait_for_element(driver, By.CSS_SELECTOR, 'ul.nav.nav-tabs')
@@ -264,41 +834,64 @@ def export_related_csvs(driver, session, charge, Attachment, retries=2):
 				# there are two tabs called 'Routing Requests' with different data
 				if tab_name == 'Routing Requests':
 					tab_name = f"{tab_name}_{index + 1}"
+				tab_subdir = tab_name.replace('/', '_')
+				if tab_subdir in abandoned_tabs:
+					print(f"	[{index + 1}/{total_tabs}] Tab '{tab_name}' failed {max_tab_attempts} times, skipping")
+					continue
+				if tab_subdir in scraped_tabs:
+					print(f"	[{index + 1}/{total_tabs}] Tab '{tab_name}' already scraped, skipping")
+					continue
 
 				print(f"	[{index + 1}/{total_tabs}] Clicking on tab: '{tab_name}'")
 
+				tab_pane = tab_pane_xpath.format(index=index + 1)
 				# click tab -- Retry mechanism to avoid stale element or timing issues
 				for attempt in range(retries):
 					try:
 						# Wait to ensure tab is clickable
-						wait_for_element(driver, By.CSS_SELECTOR, 'a.au-target', EC.element_to_be_clickable)
+						wait_for_element(driver, By.CSS_SELECTOR, 'a.au-target', EC.element_to_be_clickable, kind="tab clickable")
 						# Click the tab
 						tab.click()
-						time.sleep(0.5)
+						# the tab is shown once its pane is visible
+						wait_for_element(driver, By.XPATH, tab_pane, EC.visibility_of_element_located, 10, kind="tab shown")
 						break  # Exit retry loop if successful
 					except (StaleElementReferenceException, ElementNotInteractableException, TimeoutException) as e:
 						# If error still occurs on last retry attempt, raise the error and continue
 						if attempt == retries - 1:
 							raise e  # Re-raise after final attempt
 						print(f"		- Retry clicking on tab '{tab_name}' (attempt {attempt + 1}/{retries})")
-						time.sleep(0.5)
-
-				# check if tab contains "No Results" element (meaning there is no data) and skip tab if so
-				try:
-					# uses full XPath for element to avoid error with Kohls' show/hide DOM structure
-					no_results_alert = driver.find_element(By.XPATH,
-					                                       f"/html/body/router-view/main-layout/div/main/div/div[2]/tab-container/div/div[2]/div/div/div/div[{index + 1}]/tab-data-tables/div/div[2]/div")
-					if "No Results" in no_results_alert.text:
-						print(f"		- No data found in tab '{tab_name}', skipping export")
-						continue  # Skip to the next tab
-				except NoSuchElementException:
-					pass  # Proceed if "No Results" alert is not found (meaning there is data present)
+						# the tab element may have been re-rendered, locate it again for the next attempt
+						tab = wait_for_element(driver, By.CSS_SELECTOR, 'ul.nav.nav-tabs').find_elements(By.CSS_SELECTOR, 'a.au-target')[index]
+
+				# the tab's data is loaded once its pane holds either the "No Results" alert or the data table with its
+				# rows and a clickable export button (the table element is rendered before its rows arrive)
+				# uses full XPaths for the elements to avoid error with Kohls' show/hide DOM structure
+				outcome, _ = wait_for_any(driver, {
+					"no results": ((By.XPATH, f"{tab_pane}/tab-data-tables/div/div[2]/div"), has_no_results_text),
+					"results": ((By.XPATH, f"{tab_pane}/tab-data-tables/div/div[2]/data-table"), tab_table_ready),
+				}, timeout=10, kind="tab data")
+				# skip the tab's export if it has no data
+				if outcome == "no results":
+					print(f"		- No data found in tab '{tab_name}', skipping export")
+					record_tab(session, charge, tab_subdir, tab_empty)
+					continue  # Skip to the next tab
 
 				# scrape file links - only these tabs in the array contain file links
 				if tab_name in ['Docs & Pics', 'Reports']:
 					print("		- Getting Attachement Links")
 					get_attachment_links(driver, session, tab_name, charge, Attachment)
 
+				if on_tab_rows is not None:
+					table = extract_table_rows(driver, f"{tab_pane}/tab-data-tables/div/div[2]/data-table")
+					if table_complete(table):
+						file_path = None
+						if persist_csv:
+							file_path = save_tab_rows(session, tab_subdir, charge, table['headers'], table['rows'])
+						if store_rows(tab_subdir, table['headers'], table['rows'], file_path):
+							print(f"		- {len(table['rows'])} rows read from tab '{tab_name}'\n")
+						continue
+					print(f"		- Tab '{tab_name}' is paginated or its table could not be read whole, exporting it instead")
+
 				# Set up the download directory for the current tab. Subdirectory name mimics tab name
 				tab_directory = os.path.join(downloads_dir, tab_name.replace('/', '_'))
 				if not os.path.exists(tab_directory):
@@ -306,8 +899,9 @@ def export_related_csvs(driver, session, charge, Attachment, retries=2):
 					os.makedirs(tab_directory)
 					print(f"		- Created directory: {tab_directory}")
 				# switch download directory to tab's subdirectory within 'downloads' before exporting (downloads/{tab name})
-				set_download_directory(driver, tab_directory)
-				print(f"		- Download directory set to: {tab_directory}")
+				download_directory = staging_dir or tab_directory
+				set_download_directory(driver, download_directory)
+				print(f"		- Download directory set to: {download_directory}")
 
 				# click 'export to csv' button -- Retry mechanism for finding the export button
 				for attempt in range(retries):
@@ -318,22 +912,24 @@ def export_related_csvs(driver, session, charge, Attachment, retries=2):
 							By.XPATH,
 							f'/html/body/router-view/main-layout/div/main/div/div[2]/tab-container/div/div[2]/div/div/div/div[{index + 1}]/tab-data-tables/div/div[2]/data-table/div[2]/div[2]/div/div/a[3]',
 							EC.element_to_be_clickable,
-							timeout=5
+							timeout=5,
+							kind="export clickable"
 						)
+						clear_download_events(driver)
 						export_button.click()
 						print(f"		- Export button clicked for tab: '{tab_name}'")
-						time.sleep(0.5)
+						# wait_for_download waits for the export to arrive
 						break  # Exit retry loop if successful
 					except (TimeoutException, NoSuchElementException, StaleElementReferenceException) as e:
 						# If error still occurs on last retry attempt, raise the error and continue
 						if attempt == retries - 1:
 							raise e  # Re-raise after final attempt
+						# the next attempt's wait_for_element waits for the button to be clickable again
 						print(
 							f"		- Retry locating export button in tab '{tab_name}' (attempt {attempt + 1}/{retries})")
-						time.sleep(0.5)
 
 				# Wait for the file to be downloaded
-				latest_csv_file = wait_for_file(tab_directory)
+				latest_csv_file = wait_for_download(driver, download_directory)
 
 				if latest_csv_file:
 					# rename the file to contain the tab name and the charge number
@@ -342,16 +938,42 @@ def export_related_csvs(driver, session, charge, Attachment, retries=2):
 					if os.path.exists(new_filename):
 						# Delete the old file
 						os.remove(new_filename)
-					# Rename the downloaded file
-					os.rename(latest_csv_file, new_filename)
+					# Rename the downloaded file (moved out of the staging directory, which can be on another drive)
+					shutil.move(latest_csv_file, new_filename)
 					print(f"		- File downloaded and renamed to: {new_filename.split('/')[-1]}\n")
+					# record the file in the download manifest so the importer does not have to search for it
+					record_download(session, tab_name.replace('/', '_'), new_filename, charge_number=charge)
+					if on_tab_rows is not None:
+						# exported because the table could not be read from the DOM, hand its rows over all the same
+						with open(new_filename, newline='') as file:
+							reader = csv.reader(file)
+							headers = next(reader, [])
+							rows = list(reader)
+						store_rows(tab_subdir, headers, rows, new_filename)
+					else:
+						record_tab(session, charge, tab_subdir, tab_exported, new_filename)
 				else:
 					print(f"		- No CSV file found for tab: '{tab_name}' for charge: '{charge}'\n")
+					tab_failed(tab_subdir, "no CSV file downloaded")
 
 			except (
 			TimeoutException, NoSuchElementException, StaleElementReferenceException, WebDriverException) as tab_error:
 				print(f"		! Error: {tab_error} while processing tab '{tab_name}' for charge '{charge}'")
+				if tab_subdir:
+					tab_failed(tab_subdir, tab_error)
+				else:
+					# the tab could not even be located, there is nothing to journal it under
+					failed_tabs.append(f"tab {index + 1}")
 				continue
+		if failed_tabs:
+			# the journaled tabs are kept, the next run only scrapes these again
+			print(f"		! Tabs {failed_tabs} of charge '{charge}' failed, they are retried on the next run")
+			return False
+		if abandoned_tabs:
+			print(
+				f"		! Tabs {abandoned_tabs} of charge '{charge}' failed {max_tab_attempts} times and are given up on, "
+				f"the charge is completed without them"
+			)
 		# Return True if the process successfully runs through all the tabs without ending early
 		return True
 	except Exception as general_error:
@@ -360,6 +982,25 @@ def export_related_csvs(driver, session, charge, Attachment, retries=2):
 		return False
 
 
+# Returns [filename, link] for every row of an attachment table (XPath in arguments[0]), read in the browser in one
+# call. The last tbody is the table's footer and is left out
+attachment_links_script = """
+const table = document.evaluate(arguments[0], document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+if (!table) { return null; }
+const bodies = Array.from(table.querySelectorAll(':scope > tbody')).slice(0, -1);
+const links = [];
+for (const body of bodies) {
+	const link = body.querySelector('tr > td:nth-child(2) data-table-cell a');
+	if (!link) { continue; }
+	const span = link.querySelector('span');
+	links.push([(span ? span.innerText : link.innerText).trim(), link.href]);
+}
+return links;
+"""
+
+
+# Record the attachment links of a Docs & Pics / Reports tab. The links are read with one script call, compared
+# against the Charge's attachments with one query and the new ones are added in a single commit
 def get_attachment_links(driver, session, tab, charge, Attachment):
 	table_path = ''
 	if tab == 'Docs & Pics':
@@ -368,72 +1009,126 @@ def get_attachment_links(driver, session, tab, charge, Attachment):
 		table_path = '/html/body/router-view/main-layout/div/main/div/div[2]/tab-container/div/div[2]/div/div/div/div[4]/tab-data-tables/div/div[2]/data-table/div[4]/table'
 
 	try:
-		table = wait_for_element(driver, By.XPATH, table_path, timeout=10)
+		wait_for_element(driver, By.XPATH, table_path, timeout=10)
 	except Exception:
 		print(f"		- table not found in {tab}")
 		return
 
-	table_rows = table.find_elements(By.TAG_NAME, 'tbody')
-	for i, row in enumerate(table_rows):
-		if row == table_rows[-1]:
+	with wait_timer.time("link harvest"):
+		links = driver.execute_script(attachment_links_script, table_path) or []
+
+	existing = {
+		filename for filename, in session.query(Attachment.filename).filter_by(charge_number=charge)
+	}
+	new_attachments = []
+	for file_name, file_link in links:
+		if not file_name or file_name in existing:
+			continue
+		new_attachments.append(Attachment(
+			filename=file_name,
+			link=file_link,
+			downloaded=False,
+			charge_number=charge
+		))
+		existing.add(file_name)
+
+	if new_attachments:
+		session.add_all(new_attachments)
+		session.commit()
+	print(f"		- {len(new_attachments)} attachments added, {len(links) - len(new_attachments)} already recorded")
+
+
+# scrape the attachment data within the attachment tab. Returns the StoredFile it was saved to (see save_data_url)
+def scrape_attachments(driver, download_path, link, filename):
+	print(f"\nNavigating to Attachment {filename}")
+	driver.execute_script(clear_viewers_script)
+	# switch the loaded app to the attachment's route, only the URL change is waited for here: the viewer wait below
+	# tells whether the attachment rendered and reloads the app once if it did not
+	in_app = navigate_in_app(driver, link, lambda driver: True, "attachment navigation")
+	if not in_app:
+		# wait until URL contains the param before continuing
+		wait_until(driver, EC.url_contains(link), "attachment navigation")
+
+	while True:
+		try:
+			# the viewer is ready once its iframe/img holds the file's base64 data URL
+			file_url = wait_until(driver, attribute_starts_with((By.TAG_NAME, attachment_tag(filename)), 'src', 'data:'), "attachment content")
 			break
-		link_tag = row.find_element(By.XPATH, f'/html/body/router-view/main-layout/div/main/div/div[2]/tab-container/div/div[2]/div/div/div/div[{4 if tab == "Reports" else 3}]/tab-data-tables/div/div[2]/data-table/div[4]/table/tbody[{i+1}]/tr/td[2]/data-table-cell/a')
-		file_link = link_tag.get_attribute('href')
-		file_name = link_tag.find_element(By.TAG_NAME, 'span').text.strip()
-
-		existing_attachment = session.query(Attachment).filter_by(filename=file_name, charge_number=charge).first()
-		if not existing_attachment:
-			new_attachent = Attachment(
-				filename=file_name,
-				link=file_link,
-				downloaded=False,
-				charge_number=charge
-			)
-			session.add(new_attachent)
-			session.commit()
-			print(f"		- Attachment added: {new_attachent}")
-		else:
-			print(f"		- Attachment already exists: {existing_attachment}")
+		except Exception as e:
+			if in_app:
+				# the app did not load the attachment in place, reload it once
+				print("		! The viewer did not load in place, reloading it")
+				in_app = False
+				reload_app(driver, link)
+				try:
+					wait_until(driver, EC.url_contains(link), "attachment navigation")
+				except TimeoutException:
+					print(f"Failed to load Attachment {filename} after reloading")
+					return False
+				continue
+			print(f"Failed to locate image or document: {e}")
+			return False
 
+	if file_url:
+		return save_data_url(file_url, download_path, filename)
 
-# scrape the attachment data within the attachment tab
-def scrape_attachments(driver, download_path, link, filename):
-	print(f"\nNavigating to Attachment {filename}")
-	driver.get(link)
-	time.sleep(0.5)
-	driver.refresh()
-	# wait until URL contains the param before continuing
-	WebDriverWait(driver, 10).until(EC.url_contains(link))
-	time.sleep(1)
 
-	try:
-		if filename.endswith('.pdf'):
-			pdf_viewer = wait_for_element(driver, By.TAG_NAME, 'iframe', timeout=10)
-			file_url = pdf_viewer.get_attribute('src')
-		else:
-			img_element = wait_for_element(driver, By.TAG_NAME, 'img', timeout=10)
-			file_url = img_element.get_attribute('src')
-	except Exception as e:
-		print(f"Failed to locate image or document: {e}")
-		return False
+# tag of the attachment viewer element holding the file: PDFs are shown in an iframe, everything else in an img
+def attachment_tag(filename):
+	return 'iframe' if filename.endswith('.pdf') else 'img'
 
-	if file_url:
-		header, encoded_data = file_url.split(',', 1)  # extract base64 data
-		image_data = base64.b64decode(encoded_data)  # decode base64 to binary
 
-		if not os.path.exists(download_path):
-			os.makedirs(download_path)
+# an attachment file in the content addressed store: its path, SHA-256 and size in bytes
+StoredFile = namedtuple("StoredFile", ["path", "sha256", "size"])
 
-		file_name = os.path.join(download_path, filename)  # create file path
+# characters of base64 decoded per chunk by save_data_url (a multiple of 4 so every chunk decodes on its own)
+data_url_chunk_size = 4 * 256 * 1024
 
-		try:
-			with open(file_name, 'wb') as file:
-				file.write(image_data)  # create file
-			print(f"Downloaded attachment to {file_name}")
-			return file_name  # return the file path
-		except Exception as e:
-			print(f"Error occurred while trying to save file: {e}")
-			return False
+
+# Decode an attachment's base64 data URL into the content addressed store under download_path:
+# <download_path>/<first 2 hex chars>/<sha256><extension of filename>. The data is decoded a chunk at a time straight
+# to a temporary file while it is hashed, so neither the base64 text nor the decoded file is copied whole in memory.
+# Identical files (the same PDF attached to many Charges) are stored once, a file already in the store is left as it
+# is and the temporary copy dropped. Returns a StoredFile, False if the file could not be saved
+def save_data_url(file_url, download_path, filename):
+	# the base64 data starts after the 'data:<type>;base64,' header
+	data_start = file_url.index(',') + 1
+	digest = hashlib.sha256()
+	size = 0
+
+	if not os.path.exists(download_path):
+		os.makedirs(download_path)
+
+	temp_file = None
+	try:
+		with tempfile.NamedTemporaryFile(dir=download_path, suffix='.part', delete=False) as file:
+			temp_file = file.name
+			for start in range(data_start, len(file_url), data_url_chunk_size):
+				chunk = base64.b64decode(file_url[start:start + data_url_chunk_size])  # decode base64 to binary
+				digest.update(chunk)
+				file.write(chunk)
+				size += len(chunk)
+		if size == 0:
+			raise ValueError(f"no file data in the data URL of {filename}")
+
+		sha256 = digest.hexdigest()
+		store_directory = os.path.join(download_path, sha256[:2])
+		if not os.path.exists(store_directory):
+			os.makedirs(store_directory)
+		file_name = os.path.join(store_directory, f"{sha256}{os.path.splitext(filename)[1].lower()}")
+
+		if os.path.exists(file_name):
+			os.remove(temp_file)
+			print(f"Attachment {filename} already stored at {file_name}")
+		else:
+			os.replace(temp_file, file_name)
+			print(f"Downloaded attachment {filename} to {file_name}")
+		return StoredFile(file_name, sha256, size)
+	except Exception as e:
+		print(f"Error occurred while trying to save file: {e}")
+		if temp_file and os.path.exists(temp_file):
+			os.remove(temp_file)
+		return False
 
 
 
@@ -3,12 +3,19 @@ import sys
 currentdir = os.path.dirname(os.path.realpath(__file__))
 parentdir = os.path.dirname(currentdir)
 sys.path.append(parentdir)
-from csv_scraper import setup_driver, login, scrape_attachments, downloads_dir
+from csv_scraper import (
+	setup_driver, login, scrape_attachments, downloads_dir, wait_timer, attachment_tag, save_data_url, set_asset_blocking,
+	clear_viewers_script, start_in_app_navigation
+)
 from data_import.main import setup_database
 from data_import.models import Attachment, Document, Report
 import requests
 import time
 import os
+from collections import deque
+from datetime import datetime, timedelta
+from sqlalchemy import or_
+from selenium.common.exceptions import WebDriverException
 from urllib.parse import urlparse, parse_qs
 
 
@@ -36,39 +43,195 @@ def relate_attachment(session, attachment):
 		print(f"No matching records found.")
 
 
-def get_attachments_process(session, driver):
+# Get the Attachments waiting in the fetcher's retry queue: not downloaded, under max_attempts failed fetches and due
+# for another try. charges: only the Attachments of these Charges
+def get_attachments_to_fetch(session, max_attempts=5, charges=None):
+	print(f"\nGetting Attachments to fetch...")
+	query = session.query(Attachment).filter(
+		Attachment.downloaded == False,
+		Attachment.attempts < max_attempts,
+		or_(Attachment.next_attempt_at == None, Attachment.next_attempt_at <= datetime.now())
+	)
+	if charges is not None:
+		query = query.filter(Attachment.charge_number.in_(charges))
+	attachments = query.all()
+	print(f"Found {len(attachments)} Attachments to fetch.")
+	return attachments
+
+
+# Spaces out the fetches started against each host by at least min_interval seconds
+class HostRateLimiter:
+	def __init__(self, min_interval=0.5):
+		self.min_interval = min_interval
+		self.last_start = {}
+
+	def ready(self, url):
+		return time.time() - self.last_start.get(urlparse(url).netloc, 0) >= self.min_interval
+
+	def started(self, url):
+		self.last_start[urlparse(url).netloc] = time.time()
+
+
+# mark an Attachment downloaded to the stored file (csv_scraper.StoredFile) and relate it to its Document/Report.
+# Does not commit
+def mark_attachment_downloaded(session, attachment, stored_file):
+	attachment.downloaded = True
+	attachment.file_path = stored_file.path
+	attachment.sha256 = stored_file.sha256
+	attachment.file_size = stored_file.size
+	print(f"Marking Attachment as downloaded...")
+	relate_attachment(session, attachment)
+
+
+# Write the outcome of a fetch to the Attachment (committed by the caller in batches). A failed fetch goes back in the
+# retry queue, waiting retry_delay seconds doubled for every earlier failure
+def record_fetch_result(session, attachment, stored_file=None, error=None, retry_delay=300):
+	if stored_file:
+		mark_attachment_downloaded(session, attachment, stored_file)
+		attachment.last_error = None
+		attachment.next_attempt_at = None
+		print(f"Done: {attachment}")
+	else:
+		attachment.attempts = (attachment.attempts or 0) + 1
+		attachment.last_error = str(error)[:500]
+		attachment.next_attempt_at = datetime.now() + timedelta(seconds=retry_delay * 2 ** (attachment.attempts - 1))
+		print(f"Failed to fetch {attachment.filename} (attempt {attachment.attempts}): {error}")
+
+
+# Load an Attachment's viewer in the current tab as a new page without waiting for it: start from a blank page so the
+# previous Attachment's viewer is never read (the portal is an SPA, the file data arrives after the load anyway)
+def load_attachment_page(driver, link):
+	driver.get("about:blank")
+	driver.execute_script("window.location.href = arguments[0];", link)
+
+
+# Fetch Attachments concurrently in background tabs of the logged in driver. Every tab loads one Attachment's viewer
+# at a time without blocking: the tabs are polled in turn and a tab's file is saved as soon as its data URL is there,
+# then the tab starts on the next Attachment. New fetches against a host are rate limited (see HostRateLimiter),
+# a fetch that is not done after timeout seconds fails. Results are committed every batch_size Attachments.
+# A tab already showing the app switches to the next Attachment's route in place, if its viewer has no file after
+# reload_after seconds the tab is reloaded once
+def fetch_attachments_concurrently(session, driver, attachments, tabs=4, min_interval=0.5, timeout=30, batch_size=25, retry_delay=300, reload_after=10):
+	download_path = os.path.join(downloads_dir, 'attachments')
+	limiter = HostRateLimiter(min_interval)
+	waiting = deque(attachments)
+	# tab handle -> (Attachment, start time, whether it was loaded in place) of the fetch running in it
+	active = {}
+	uncommitted = 0
+	fetched = failed = 0
+	start_time = time.time()
+
+	main_window = driver.current_window_handle
+	handles = []
+	for _ in range(min(tabs, len(attachments))):
+		driver.switch_to.new_window('tab')
+		handles.append(driver.current_window_handle)
+
+	try:
+		while waiting or active:
+			for handle in handles:
+				if handle in active:
+					attachment, started_at, in_app = active[handle]
+					try:
+						driver.switch_to.window(handle)
+						file_url = driver.execute_script(
+							"const viewer = document.querySelector(arguments[0]);"
+							"return viewer && viewer.src && viewer.src.startsWith('data:') ? viewer.src : null;",
+							attachment_tag(attachment.filename)
+						)
+						if file_url:
+							stored_file = save_data_url(file_url, download_path, attachment.filename)
+							error = None if stored_file else "could not save file"
+						elif in_app and time.time() - started_at > reload_after:
+							# the app did not load the Attachment in place, reload the tab and start the fetch over
+							load_attachment_page(driver, attachment.link)
+							active[handle] = (attachment, time.time(), False)
+							continue
+						elif time.time() - started_at > timeout:
+							stored_file, error = None, f"no file data after {timeout} seconds"
+						else:
+							# still loading
+							continue
+					except WebDriverException as e:
+						stored_file, error = None, e.msg or e
+
+					record_fetch_result(session, attachment, stored_file, error, retry_delay)
+					if stored_file:
+						fetched += 1
+					else:
+						failed += 1
+					uncommitted += 1
+					del active[handle]
+
+				if waiting and limiter.ready(waiting[0].link):
+					attachment = waiting.popleft()
+					driver.switch_to.window(handle)
+					# the previous Attachment's viewer must never be read as this one's
+					driver.execute_script(clear_viewers_script)
+					in_app = start_in_app_navigation(driver, attachment.link)
+					if not in_app:
+						load_attachment_page(driver, attachment.link)
+					limiter.started(attachment.link)
+					active[handle] = (attachment, time.time(), in_app)
+
+			if uncommitted >= batch_size:
+				session.commit()
+				uncommitted = 0
+			time.sleep(0.05)
+		session.commit()
+	finally:
+		for handle in handles:
+			driver.switch_to.window(handle)
+			driver.close()
+		driver.switch_to.window(main_window)
+
+	elapsed = time.time() - start_time
+	print(f"\nFetched {fetched} Attachments ({failed} failed) in {round(elapsed, 2)} Seconds with {len(handles)} tabs")
+
+
+# tabs=N fetches the Attachments of the retry queue concurrently in N background tabs (fetch_attachments_concurrently)
+# instead of one at a time
+def get_attachments_process(session, driver, tabs=None):
+	# a driver started with the scraping profile blocks images, which attachments can be
+	if getattr(driver, 'assets_blocked', False):
+		set_asset_blocking(driver, False)
+
+	if tabs:
+		attachments = get_attachments_to_fetch(session)
+		if attachments:
+			fetch_attachments_concurrently(session, driver, attachments, tabs)
+		return
+
 	attachments_to_download = get_non_downloaded_attachments(session)
 
 	for attachment in attachments_to_download:
 		download_path = os.path.join(downloads_dir, 'attachments')
-		new_file_path = scrape_attachments(driver, download_path, attachment.link, attachment.filename)
-		if new_file_path:
-			attachment.downloaded = True
-			attachment.file_path = new_file_path
-			print(f"Marking Attachment as downloaded...")
-			relate_attachment(session, attachment)
+		stored_file = scrape_attachments(driver, download_path, attachment.link, attachment.filename)
+		if stored_file:
+			mark_attachment_downloaded(session, attachment, stored_file)
 			session.commit()
 			print(f"Done: {attachment}")
 		else:
 			continue
 
+	# how long the attachment page waits took over the run
+	wait_timer.print_report()
+
 
 if __name__ == '__main__':
 	engine, session = setup_database()
 
 	attachments_to_download = get_non_downloaded_attachments(session)
 
-	driver = setup_driver()
+	# attachments are saved from the page, not downloaded by the browser
+	driver = setup_driver(warm=True, downloads=False)
 	login(driver)
 
 	for attachment in attachments_to_download:
 		download_path = os.path.join(downloads_dir, 'attachments')
-		new_file_path = scrape_attachments(driver, download_path, attachment.link, attachment.filename)
-		if new_file_path:
-			attachment.downloaded = True
-			attachment.file_path = new_file_path
-			print(f"Marking Attachment as downloaded...")
-			relate_attachment(session, attachment)
+		stored_file = scrape_attachments(driver, download_path, attachment.link, attachment.filename)
+		if stored_file:
+			mark_attachment_downloaded(session, attachment, stored_file)
 			session.commit()
 			print(f"Done: {attachment}")
 		else:
@@ -8,12 +8,16 @@ sys.path.append(parentdir)
 from data_import.models import Calendar
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
-from data_recruit.csv_scraper import setup_driver, login, navigate_to_charges, fill_search_criteria, export_charges_csv
+from data_recruitment.csv_scraper import setup_driver, login, navigate_to_charges, fill_search_criteria, export_charges_csv
 from data_import.main import setup_database
 
+# incremental runs only re-export a month once its last export is older than this
+calendar_ttl = timedelta(hours=24)
+
 
 # Enables past calendars to be pulled and imported. takes in Int that represent the amount of months back to enable
-def enable_past_calendars(session, months_back):
+# ttl: when passed in (timedelta), only months last exported longer ago than ttl (or never) are enabled
+def enable_past_calendars(session, months_back, ttl=None):
 	try:
 		today = datetime.today()
 		last_of_current_month = (today + relativedelta(months=1)).replace(day=1) - timedelta(days=1)
@@ -25,6 +29,12 @@ def enable_past_calendars(session, months_back):
 			Calendar.start_date >= n_months_ago,
 			Calendar.start_date < last_of_current_month + timedelta(days=1)
 		).all()
+		if ttl is not None:
+			pulled_before = datetime.now() - ttl
+			fresh = [c for c in previous_calendars if c.last_pulled_at and c.last_pulled_at > pulled_before]
+			previous_calendars = [c for c in previous_calendars if c not in fresh]
+			if fresh:
+				print(f"Skipping {len(fresh)} months exported in the last {ttl}: {fresh}")
 
 		# Mark those Calendars as 'unpulled' and 'unimported' so they can be processed by the next steps
 		for c in previous_calendars:
@@ -51,24 +61,27 @@ def get_unpulled_calendars(session):
 def mark_calendar_pulled(session, month):
 	try:
 		month.pulled = True
+		month.last_pulled_at = datetime.now()
 		session.commit()
 		print(f"Month marked as pulled: {month}")
 	except Exception as e:
 		print(f"An error occurred while trying to marked month as pulled: {e}")
 
 
-def run_calender_process(session):
-	enable_past_calendars(session, 3)
+# incremental=True only re-enables the months whose export is older than calendar_ttl
+def run_calender_process(session, incremental=False):
+	enable_past_calendars(session, 3, calendar_ttl if incremental else None)
 	# get all unpulled Calendars
 	months_to_search = get_unpulled_calendars(session)
 
 	return months_to_search
 
 # Function with process to get charges to be used in full_process.py. Takes in a DB session and web driver
-def get_charges_process(session, driver):
+# incremental: see run_calender_process
+def get_charges_process(session, driver, incremental=False):
 	try:
 		# enable Calendars
-		months_to_search = run_calender_process(session)
+		months_to_search = run_calender_process(session, incremental)
 
 		# Navigate and Log in to Kohls portal
 		print("\nLogging in...")
@@ -90,7 +103,7 @@ def get_charges_process(session, driver):
 
 			print("Clicking Export to CSV button...")
 			# Export the resulting Charges to CSV
-			successful_export = export_charges_csv(driver, month)
+			successful_export = export_charges_csv(driver, month, session)
 			if successful_export:
 				print("CSV saved and renamed.")
 				print(f"Marking {month.month}-{month.year} as pulled...")
@@ -110,7 +123,7 @@ if __name__ == '__main__':
 		months_to_search = get_unpulled_calendars(session)
 
 		print("\nStarting Web Driver...")
-		driver = setup_driver()
+		driver = setup_driver(warm=True)
 
 		# process remains the same but passes in the dedicated session and driver
 		print("\nLogging in...")
@@ -125,7 +138,7 @@ if __name__ == '__main__':
 			print(f"Filling search criteria for {month.month}-{month.year}...")
 			fill_search_criteria(driver, start, end)
 			print("Clicking Export to CSV button...")
-			export_charges_csv(driver, month)
+			export_charges_csv(driver, month, session)
 			print("CSV saved and renamed.")
 			print(f"Marking {month.month}-{month.year} as pulled...")
 			mark_calendar_pulled(session, month)
@@ -5,9 +5,19 @@ currentdir = os.path.dirname(os.path.realpath(__file__))
 parentdir = os.path.dirname(currentdir)
 sys.path.append(parentdir)
 
-from data_recruitment.csv_scraper import scrape_charge_data, setup_driver, login
+import queue
+import threading
+import time
+from collections import deque
+from sqlalchemy.orm import sessionmaker
+from data_recruitment.csv_scraper import scrape_charge_data, setup_driver, login, downloads_dir, wait_timer, profile_dir
 from data_import.models import Charge, Attachment
 from data_import.main import setup_database
+from data_import.import_related_data import store_tab_rows
+from data_import.journal import clear_journal
+
+# each worker of the scraping pool downloads into its own subdirectory of this directory
+staging_root = os.path.join(downloads_dir, "staging")
 
 
 # Get all Charges marked as 'unpulled'
@@ -22,9 +32,210 @@ def get_unpulled_charges(session):
 	return charges
 
 
+# Shared pause between Charges for the workers of a scraping pool. Tracks the outcome of the last window Charges: every
+# failure while more than error_threshold of them failed doubles the pause (up to max_delay), every success once the
+# error rate is back under the threshold halves it again (down to min_delay)
+class Throttle:
+	def __init__(self, min_delay=0.5, max_delay=60, error_threshold=0.2, window=20):
+		self.min_delay = min_delay
+		self.max_delay = max_delay
+		self.error_threshold = error_threshold
+		self.delay = min_delay
+		self.results = deque(maxlen=window)
+		self.lock = threading.Lock()
+
+	def wait(self):
+		time.sleep(self.delay)
+
+	def record(self, successful):
+		with self.lock:
+			self.results.append(successful)
+			error_rate = self.results.count(False) / len(self.results)
+			if not successful and error_rate > self.error_threshold:
+				new_delay = min(self.delay * 2, self.max_delay)
+				if new_delay != self.delay:
+					print(f"\nPortal error rate at {round(error_rate * 100)}%, slowing down to {new_delay}s between Charges")
+				self.delay = new_delay
+			elif successful and error_rate <= self.error_threshold:
+				self.delay = max(self.delay / 2, self.min_delay)
+
+
+# Per worker counts of a scraping pool run
+class WorkerStats:
+	def __init__(self, worker_id):
+		self.worker_id = worker_id
+		self.pulled = 0
+		self.failed = 0
+		self.restarts = 0
+		self.startup_failures = 0
+		self.start_time = time.time()
+		self.end_time = None
+
+	def report(self):
+		elapsed = (self.end_time or time.time()) - self.start_time
+		rate = round(self.pulled / (elapsed / 60), 2) if elapsed > 0 else self.pulled
+		return (
+			f"Worker {self.worker_id}: {self.pulled} pulled | {self.failed} failed | {self.restarts} browser restarts | "
+			f"{self.startup_failures} failed browser starts | "
+			f"{round(elapsed, 2)} Seconds ({rate} Charges/min)"
+		)
+
+
+# One worker of the scraping pool: its own logged in browser (downloading into its own staging directory) and DB
+# session, taking Charge numbers from the shared queue until it is empty. The browser is restarted after
+# max_consecutive_errors failed Charges in a row (e.g. the session expired or the browser crashed). A worker whose
+# browser cannot be started or logged in puts its Charge back for the other workers and stops
+def scrape_worker(worker_id, charge_queue, Session, throttle, stats, driver_lock, headless=True, max_consecutive_errors=3, warm=False):
+	staging_dir = os.path.join(staging_root, f"worker_{worker_id}")
+	if not os.path.exists(staging_dir):
+		os.makedirs(staging_dir)
+
+	session = Session()
+	driver = None
+	consecutive_errors = 0
+	try:
+		while True:
+			try:
+				charge_id = charge_queue.get_nowait()
+			except queue.Empty:
+				break
+
+			if driver is None:
+				try:
+					# webdriver_manager's driver download/cache is not safe to run from several threads at once
+					with driver_lock:
+						# each browser needs its own profile, Chrome locks a profile while it is open
+						driver = setup_driver(
+							download_dir=staging_dir, headless=headless, warm=warm,
+							warm_profile_dir=os.path.join(profile_dir, f"worker_{worker_id}")
+						)
+					login(driver)
+				except Exception as e:
+					print(f"[Worker {worker_id}] Could not start a logged in browser, Charge {charge_id} handed back: {e}")
+					charge_queue.put(charge_id)
+					stats.startup_failures += 1
+					break
+
+			# a download left behind by a failed export would otherwise be picked up as the next tab's file
+			for leftover in os.listdir(staging_dir):
+				os.remove(os.path.join(staging_dir, leftover))
+
+			throttle.wait()
+			print(f"\n[Worker {worker_id}] [{charge_queue.qsize()} left] Scraping data for Charge {charge_id}...")
+			try:
+				successful_pull = scrape_charge_data(driver, session, charge_id, Attachment, staging_dir=staging_dir)
+			except Exception as e:
+				print(f"[Worker {worker_id}] Error occurred while scraping Charge {charge_id}: {e}")
+				successful_pull = False
+			throttle.record(successful_pull)
+
+			if successful_pull:
+				# Only mark the Charge as pulled if the scraping process was successful
+				session.query(Charge).filter_by(id=charge_id).update({'pulled': True})
+				session.commit()
+				stats.pulled += 1
+				consecutive_errors = 0
+				print(f"[Worker {worker_id}] Done: Charge {charge_id} marked pulled")
+			else:
+				session.rollback()
+				stats.failed += 1
+				consecutive_errors += 1
+				print(f"[Worker {worker_id}] Data incomplete, Charge {charge_id} not marked as pulled.")
+				if consecutive_errors >= max_consecutive_errors:
+					print(f"[Worker {worker_id}] {consecutive_errors} failed Charges in a row, restarting browser...")
+					driver.quit()
+					driver = None
+					consecutive_errors = 0
+					stats.restarts += 1
+	except Exception as e:
+		print(f"\n[Worker {worker_id}] Stopped: {e}")
+	finally:
+		stats.end_time = time.time()
+		if driver is not None:
+			driver.quit()
+		session.close()
+
+
+# Scrape the related data of all unpulled Charges with a pool of workers headless browsers (see scrape_worker).
+# Charges are handed out from a shared queue and each worker marks its own Charges pulled. Takes in a DB session whose
+# engine the workers' sessions are created from. warm: warm start the browsers (see csv_scraper.setup_driver)
+def get_related_data_pool_process(session, workers=3, headless=True, warm=False):
+	charges = get_unpulled_charges(session)
+	if not charges:
+		return
+
+	charge_queue = queue.Queue()
+	for charge in charges:
+		charge_queue.put(charge.id)
+
+	workers = max(1, min(workers, len(charges)))
+	print(f"\n{len(charges)} Charges to Scrape with {workers} workers")
+	Session = sessionmaker(bind=session.get_bind())
+	throttle = Throttle()
+	driver_lock = threading.Lock()
+	stats = [WorkerStats(worker_id) for worker_id in range(1, workers + 1)]
+
+	threads = [
+		threading.Thread(
+			target=scrape_worker,
+			args=(worker_stats.worker_id, charge_queue, Session, throttle, worker_stats, driver_lock, headless),
+			kwargs={"warm": warm},
+			name=f"scrape-worker-{worker_stats.worker_id}"
+		)
+		for worker_stats in stats
+	]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	print("\nScraping pool finished:")
+	for worker_stats in stats:
+		print(worker_stats.report())
+	print(f"Total: {sum(s.pulled for s in stats)} pulled | {sum(s.failed for s in stats)} failed | {charge_queue.qsize()} not attempted")
+	# the Charges were marked pulled by the workers' sessions
+	session.expire_all()
+
+
+# Scrape the related data of all unpulled Charges reading every tab's table straight from the DOM and importing the
+# rows in memory (store_tab_rows), without the CSV download, rename and re-read. A Charge is marked pulled and imported
+# together once all its tabs are stored. persist_csv=True also saves each tab's rows as its CSV for auditing
+def get_related_data_dom_process(session, driver, persist_csv=False):
+	charges = get_unpulled_charges(session)
+
+	# handed to the scraper so csv_scraper does not have to import the importer
+	def on_tab_rows(charge, subdir, headers, rows):
+		store_tab_rows(session, charge, subdir, headers, rows)
+
+	print(f"\n{len(charges)} Charges to Scrape")
+	for index, charge in enumerate(charges):
+		print(f"\n[{index+1}/{len(charges)}] Scraping data for Charge {charge.id}...")
+		successful_pull = scrape_charge_data(
+			driver, session, charge.id, Attachment, on_tab_rows=on_tab_rows, persist_csv=persist_csv
+		)
+		if successful_pull:
+			charge.pulled = True
+			charge.imported = True
+			clear_journal(session, [charge.id])
+			session.commit()
+			print(f"Done: {charge} (imported)")
+		else:
+			session.rollback()
+			print(f"Data incomplete, Charge {charge.id} not marked as pulled.")
+
+
 # # Function with process to get related data to be used in full_process.py. Takes in a DB session and a web driver
-def get_related_data_process(session, driver):
+# workers=N scrapes with get_related_data_pool_process (N headless browsers of their own) instead of the passed in driver
+# engine='dom' reads and imports the tables in memory with get_related_data_dom_process
+def get_related_data_process(session, driver, workers=None, engine='ui'):
 	try:
+		if engine == 'dom':
+			get_related_data_dom_process(session, driver)
+			return
+		if workers:
+			get_related_data_pool_process(session, workers)
+			return
+
 		# Get all unpulled Charges
 		charges = get_unpulled_charges(session)
 
@@ -44,6 +255,9 @@ def get_related_data_process(session, driver):
 				print(f"Data incomplete, Charge {charge.id} not marked as pulled.")
 	except Exception as e:
 		print(f"\nError occurred while getting related data: {e}")
+	finally:
+		# how long the page/tab/download waits took over the run
+		wait_timer.print_report()
 
 
 if __name__ == '__main__':
@@ -55,7 +269,7 @@ if __name__ == '__main__':
 		charges = get_unpulled_charges(session)
 
 		print("\nStarting web driver...")
-		driver = setup_driver()
+		driver = setup_driver(warm=True)
 
 		# process remains the same but passes in the dedicated session and driver
 		print("\nLogging in...")
@@ -0,0 +1,98 @@
+import os
+import sys
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(parentdir)
+
+import time
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions as EC
+from data_recruitment.csv_scraper import (
+	setup_driver, login, wait_for_element, wait_until, reload_app, charge_shown, portal_origin
+)
+from data_import.main import setup_database
+from data_import.models import Charge
+
+# psutil is only needed for the browser memory column, the benchmark runs without it
+try:
+	import psutil
+except ImportError:
+	psutil = None
+
+# driver settings compared by benchmark_scrape_profiles: name -> setup_driver keyword arguments
+scrape_profiles = {
+	"visible": {},
+	"headless": {"headless": True},
+	"headless + blocking": {"headless": True, "block_assets": True},
+}
+
+# bytes the page transferred since the resource timings were last cleared (transferSize is 0 for blocked requests)
+transferred_bytes_script = """
+return performance.getEntriesByType('resource').reduce((total, entry) => total + (entry.transferSize || 0), 0);
+"""
+
+
+# Resident memory of the browser in MB: every process started by chromedriver (browser, renderers, GPU...).
+# None when psutil is not installed or the processes can't be read
+def browser_rss(driver):
+	if psutil is None:
+		return None
+	try:
+		processes = psutil.Process(driver.service.process.pid).children(recursive=True)
+		return sum(process.memory_info().rss for process in processes) / 1024 ** 2
+	except psutil.Error:
+		return None
+
+
+# Load each Charge page as a new document (reload_app, driver.get alone does not reload when only the hash route
+# changes) until it shows the Charge and its tabs have rendered, i.e. the full page load a profile has to do. Returns
+# the seconds each load took, the KB each transferred and the peak browser RSS in MB (None without psutil)
+def measure_charge_pages(driver, charges):
+	load_times, transferred, peak_rss = [], [], None
+	for charge in charges:
+		start_time = time.perf_counter()
+		reload_app(driver, f"{portal_origin}/#/inquiry/charge?keyNum={charge}")
+		wait_until(driver, EC.url_contains(f"keyNum={charge}"), "charge navigation")
+		wait_until(driver, charge_shown(charge), "charge shown", 30)
+		wait_for_element(driver, By.XPATH, '/html/body/router-view/main-layout/div/main/div/div[2]/tab-container/div/div[2]/div/ul')
+		load_times.append(time.perf_counter() - start_time)
+		transferred.append(driver.execute_script(transferred_bytes_script) / 1024)
+
+		rss = browser_rss(driver)
+		if rss is not None:
+			peak_rss = rss if peak_rss is None else max(peak_rss, rss)
+	return load_times, transferred, peak_rss
+
+
+# Compare page load time, page weight and browser memory of the scrape_profiles over the same Charges. Each profile
+# gets a fresh browser that loads every page once to warm the cache, the second pass is the one measured
+def benchmark_scrape_profiles(charges, profiles=None):
+	profiles = profiles or scrape_profiles
+	if psutil is None:
+		print("psutil is not installed, browser memory is not measured")
+
+	print(f"\n{'Profile':<22}{'Pages':>7}{'Mean (s)':>10}{'Max (s)':>10}{'KB/page':>10}{'Peak RSS (MB)':>15}")
+	for name, driver_settings in profiles.items():
+		driver = setup_driver(downloads=False, **driver_settings)
+		try:
+			login(driver)
+			measure_charge_pages(driver, charges)
+			load_times, transferred, peak_rss = measure_charge_pages(driver, charges)
+		finally:
+			driver.quit()
+
+		rss = f"{peak_rss:.0f}" if peak_rss is not None else "n/a"
+		print(
+			f"{name:<22}{len(load_times):>7}{sum(load_times) / len(load_times):>10.2f}{max(load_times):>10.2f}"
+			f"{sum(transferred) / len(transferred):>10.0f}{rss:>15}"
+		)
+
+
+if __name__ == '__main__':
+	# Benchmark the profiles on the most recent Charges: python scrape_benchmark.py [number of charges]
+	engine, session = setup_database()
+	charge_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+	charges = [charge.id for charge in session.query(Charge).order_by(Charge.id.desc()).limit(charge_count)]
+	session.close()
+	benchmark_scrape_profiles(charges)
@@ -0,0 +1,37 @@
+import os
+import sys
+
+# the modules import each other both as packages (data_import.main) and from their own directory (models, main,
+# csv_scraper), like the IDE's source roots
+testsdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(testsdir)
+for directory in (parentdir, os.path.join(parentdir, "data_import"), os.path.join(parentdir, "data_recruitment")):
+	if directory not in sys.path:
+		sys.path.insert(0, directory)
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+
+# SQLite file DB with foreign keys enforced, shared by the threads of a test. Returns the engine
+@pytest.fixture
+def engine(tmp_path):
+	engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+
+	@event.listens_for(engine, "connect")
+	def enforce_foreign_keys(connection, record):
+		connection.execute("PRAGMA foreign_keys=ON")
+
+	import models
+	import data_import.models
+	models.Base.metadata.create_all(engine)
+	data_import.models.Base.metadata.create_all(engine)
+	return engine
+
+
+@pytest.fixture
+def session(engine):
+	session = sessionmaker(bind=engine)()
+	yield session
+	session.close()
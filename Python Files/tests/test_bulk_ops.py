@@ -0,0 +1,59 @@
+from sqlalchemy.dialects import mssql, mysql
+
+from data_import.bulk_ops import MSSQL_MAX_PARAMS, write_rows
+from data_import.models import Charge
+
+
+# session of a MySQL/SQL Server DB that records the statements it is given instead of running them
+class RecordingSession:
+	def __init__(self, dialect):
+		self.dialect = dialect
+		self.executed = []
+
+	def get_bind(self):
+		return self
+
+	def execute(self, statement, params=None):
+		compiled = statement.compile(dialect=self.dialect)
+		self.executed.append((str(compiled), params if params is not None else compiled.params))
+
+
+def charge_rows(count):
+	return [
+		{'id': number, 'status': 'Open', 'amount': 10.0, 'site_name': 'A', 'calendar_id': 1}
+		for number in range(1, count + 1)
+	]
+
+
+def test_mysql_upsert_batches():
+	session = RecordingSession(mysql.dialect())
+	write_rows(session, Charge, charge_rows(700), charge_rows(300), batch_size=500)
+
+	assert len(session.executed) == 2
+	for sql, params in session.executed:
+		assert sql.startswith("INSERT INTO charge")
+		assert "ON DUPLICATE KEY UPDATE" in sql
+		assert "id = VALUES(id)" not in sql
+		assert "status = VALUES(status)" in sql
+		# one set of parameters per row of the multi-row VALUES
+		assert len([name for name in params if name.startswith('id_m')]) == 500
+
+
+def test_mssql_merge_stays_under_the_parameter_limit():
+	session = RecordingSession(mssql.dialect())
+	rows = charge_rows(1000)
+	write_rows(session, Charge, rows, [])
+
+	batch_size = MSSQL_MAX_PARAMS // 5
+	assert len(session.executed) == -(-len(rows) // batch_size)
+	merged = 0
+	for sql, params in session.executed:
+		assert sql.startswith("MERGE charge WITH (HOLDLOCK) AS target USING (VALUES (")
+		assert "WHEN MATCHED THEN UPDATE SET target.status = source.status" in sql
+		assert "target.id = source.id," not in sql
+		assert "WHEN NOT MATCHED THEN INSERT (id, status, amount, site_name, calendar_id)" in sql
+		# SQL Server allows 2100 bound parameters per statement
+		assert len(params) <= MSSQL_MAX_PARAMS < 2100
+		assert all(f":{name}" in sql for name in params)
+		merged += len(params) // 5
+	assert merged == len(rows)
@@ -0,0 +1,138 @@
+import json
+import os
+import threading
+import time
+
+from selenium.webdriver.common.by import By
+
+from data_recruitment.csv_scraper import (
+	clear_download_events, set_download_directory, wait_for_download, all_hold, charge_shown, tab_table_ready,
+	table_complete
+)
+
+
+# driver with download events on whose performance log returns the queued events, like Chrome's performance log
+class EventDriver:
+	download_events = True
+
+	def __init__(self, events=()):
+		self.events = list(events)
+
+	def get_log(self, kind):
+		events, self.events = self.events, []
+		return [{"message": json.dumps({"message": event})} for event in events]
+
+	def execute_cdp_cmd(self, command, params):
+		pass
+
+
+def test_download_followed_by_events(tmp_path):
+	driver = EventDriver()
+	set_download_directory(driver, str(tmp_path))
+	clear_download_events(driver)
+	driver.events = [
+		{"method": "Browser.downloadWillBegin", "params": {"guid": "abc", "suggestedFilename": "export.csv"}},
+		{"method": "Browser.downloadProgress", "params": {"guid": "abc", "state": "completed"}},
+	]
+
+	assert wait_for_download(driver, str(tmp_path), timeout=2) == os.path.join(tmp_path, "abc")
+
+
+def test_download_without_events_found_in_directory(tmp_path):
+	(tmp_path / "earlier-guid").write_text("old export")
+	driver = EventDriver()
+	set_download_directory(driver, str(tmp_path))
+	clear_download_events(driver)
+
+	# the browser saves the file under its GUID, first as .crdownload, without any event reaching the log
+	def download():
+		(tmp_path / "new-guid.crdownload").write_text("Charge Number\n1\n")
+		os.replace(tmp_path / "new-guid.crdownload", tmp_path / "new-guid")
+
+	threading.Timer(0.3, download).start()
+	started = time.time()
+	assert wait_for_download(driver, str(tmp_path), timeout=10) == os.path.join(tmp_path, "new-guid")
+	# found once its size held for a second, not after waiting for events first
+	assert time.time() - started < 2
+
+
+def test_download_finished_before_waiting_found_right_away(tmp_path):
+	driver = EventDriver()
+	set_download_directory(driver, str(tmp_path))
+	clear_download_events(driver)
+	(tmp_path / "fast-guid").write_text("Charge Number\n1\n")
+
+	started = time.time()
+	assert wait_for_download(driver, str(tmp_path), timeout=10) == os.path.join(tmp_path, "fast-guid")
+	assert time.time() - started < 2
+
+
+def test_download_without_events_times_out(tmp_path):
+	driver = EventDriver()
+	set_download_directory(driver, str(tmp_path))
+	clear_download_events(driver)
+
+	assert wait_for_download(driver, str(tmp_path), timeout=1) is None
+
+
+# driver whose page shows the charge number in shown_charge's header
+class ChargePageDriver:
+	def __init__(self, shown_charge):
+		self.shown_charge = shown_charge
+
+	def execute_script(self, script, charge):
+		return charge == str(self.shown_charge)
+
+
+def test_charge_page_rendered_only_with_the_requested_charge():
+	replaced = lambda driver: "tab container"
+	assert all_hold(replaced, charge_shown(2))(ChargePageDriver(2)) == "tab container"
+	# the view was re-rendered but still shows the previous charge (or a placeholder)
+	assert not all_hold(replaced, charge_shown(2))(ChargePageDriver(1))
+	assert not all_hold(lambda driver: False, charge_shown(2))(ChargePageDriver(2))
+
+
+class FakeElement:
+	def __init__(self, rows=0, export_button=None, displayed=True, enabled=True):
+		self.rows = rows
+		self.export_button = export_button
+		self.displayed = displayed
+		self.enabled = enabled
+
+	def find_elements(self, by, value):
+		if by == By.CSS_SELECTOR:
+			return [FakeElement()] * self.rows
+		return [self.export_button] if self.export_button else []
+
+	def is_displayed(self):
+		return self.displayed
+
+	def is_enabled(self):
+		return self.enabled
+
+
+def test_tab_table_ready_needs_rows_and_a_clickable_export():
+	assert tab_table_ready(FakeElement(rows=2, export_button=FakeElement()))
+	# rendered, rows not arrived yet
+	assert not tab_table_ready(FakeElement(rows=0, export_button=FakeElement()))
+	assert not tab_table_ready(FakeElement(rows=2))
+	assert not tab_table_ready(FakeElement(rows=2, export_button=FakeElement(enabled=False)))
+
+
+def table(rows, row_count=None, total=None, paginated=False):
+	rows = [["invoice.pdf"]] * rows
+	return {
+		"headers": ["Document Name"], "rows": rows, "row_count": len(rows) if row_count is None else row_count,
+		"total": total, "paginated": paginated
+	}
+
+
+def test_only_whole_tables_are_stored_from_the_dom():
+	assert table_complete(table(2))
+	assert table_complete(table(2, total=2))
+	assert not table_complete(None)
+	# empty or half rendered tables are exported instead
+	assert not table_complete(table(0))
+	assert not table_complete(table(2, row_count=3))
+	assert not table_complete(table(2, total=40))
+	assert not table_complete(table(2, paginated=True))
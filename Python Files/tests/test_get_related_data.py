@@ -0,0 +1,52 @@
+import queue
+import threading
+
+from sqlalchemy.orm import sessionmaker
+
+from data_recruitment import get_related_data
+from data_recruitment.get_related_data import Throttle, WorkerStats, scrape_worker
+
+
+class FakeDriver:
+	quit_called = False
+
+	def quit(self):
+		self.quit_called = True
+
+
+def run_worker(engine, charge_queue, stats):
+	scrape_worker(1, charge_queue, sessionmaker(bind=engine), Throttle(min_delay=0), stats, threading.Lock())
+
+
+def test_worker_hands_charge_back_when_browser_does_not_start(engine, tmp_path, monkeypatch):
+	def broken_setup(**kwargs):
+		raise RuntimeError("chromedriver missing")
+
+	monkeypatch.setattr(get_related_data, "staging_root", str(tmp_path))
+	monkeypatch.setattr(get_related_data, "setup_driver", broken_setup)
+	charge_queue = queue.Queue()
+	charge_queue.put(1)
+	stats = WorkerStats(1)
+	run_worker(engine, charge_queue, stats)
+
+	assert charge_queue.get_nowait() == 1
+	assert (stats.startup_failures, stats.failed, stats.pulled) == (1, 0, 0)
+
+
+def test_worker_hands_charge_back_when_login_fails(engine, tmp_path, monkeypatch):
+	driver = FakeDriver()
+
+	def broken_login(driver):
+		raise RuntimeError("login form missing")
+
+	monkeypatch.setattr(get_related_data, "staging_root", str(tmp_path))
+	monkeypatch.setattr(get_related_data, "setup_driver", lambda **kwargs: driver)
+	monkeypatch.setattr(get_related_data, "login", broken_login)
+	charge_queue = queue.Queue()
+	charge_queue.put(1)
+	stats = WorkerStats(1)
+	run_worker(engine, charge_queue, stats)
+
+	assert charge_queue.get_nowait() == 1
+	assert stats.startup_failures == 1
+	assert driver.quit_called
@@ -0,0 +1,123 @@
+import datetime
+import os
+
+import import_charges
+from import_charges import (
+	bulk_process_file_data, process_file_data, charge_fingerprint, legacy_untracked_columns, get_file_to_import,
+	stream_process_file_data, get_import_checkpoint
+)
+from models import Calendar, Charge, DownloadManifest
+from data_import.manifest import charge_files_tab
+
+
+def add_calendars(session):
+	for month in (1, 2):
+		day = datetime.date(2024, month, 1)
+		session.add(Calendar(id=month, year=2024, month=month, start_date=day, end_date=day))
+	session.commit()
+	return session.get(Calendar, 1), session.get(Calendar, 2)
+
+
+def write_charges_csv(tmp_path, rows):
+	path = os.path.join(tmp_path, "Charges.csv")
+	with open(path, "w") as file:
+		file.write("Charge Number,Status,Amount,Site Name\n")
+		file.writelines(f"{row}\n" for row in rows)
+	return path
+
+
+def test_charge_moved_to_another_month_gets_its_calendar(session, tmp_path):
+	january, february = add_calendars(session)
+	for process in (process_file_data, bulk_process_file_data):
+		session.query(Charge).delete()
+		session.commit()
+		assert process(session, january, write_charges_csv(tmp_path, ["1,Open,10,A"]), 45)
+		assert process(session, february, write_charges_csv(tmp_path, ["1,Open,10,A"]), 45)
+		session.expire_all()
+		assert session.get(Charge, 1).calendar_id == february.id
+
+
+def test_fingerprint_stored_without_calendar_is_backfilled_not_reset(session, tmp_path):
+	january, _ = add_calendars(session)
+	for process in (process_file_data, bulk_process_file_data):
+		session.query(Charge).delete()
+		session.commit()
+		assert process(session, january, write_charges_csv(tmp_path, ["1,Open,10,A"]), 45)
+		charge = session.get(Charge, 1)
+		row = {'id': 1, 'status': 'Open', 'amount': 10.0, 'site_name': 'A', 'calendar_id': january.id}
+		current_hash = charge.row_hash
+		charge.row_hash = charge_fingerprint(row, legacy_untracked_columns)
+		charge.pulled = charge.imported = True
+		session.commit()
+
+		assert process(session, january, write_charges_csv(tmp_path, ["1,Open,10,A"]), 45)
+		session.expire_all()
+		charge = session.get(Charge, 1)
+		assert (charge.pulled, charge.imported, charge.row_hash) == (True, True, current_hash)
+
+
+def test_moved_manifest_file_falls_back_to_directory(session, tmp_path, monkeypatch):
+	january, _ = add_calendars(session)
+	session.add(DownloadManifest(tab=charge_files_tab, file_path=str(tmp_path / "gone.csv"), calendar_id=january.id))
+	session.commit()
+	monkeypatch.setattr(import_charges, "downloads_dir", str(tmp_path))
+	assert get_file_to_import(january, session) is None
+
+	os.makedirs(tmp_path / "charge_files")
+	moved_file = tmp_path / "charge_files" / "Charges_1_01-01-2024_01-31-2024.csv"
+	moved_file.write_text("Charge Number\n1\n")
+	assert get_file_to_import(january, session) == str(moved_file)
+
+
+def test_streaming_import_resumes_from_checkpoint(session, tmp_path, monkeypatch):
+	january, _ = add_calendars(session)
+	file = write_charges_csv(tmp_path, [f"{number},Open,10,A" for number in range(1, 6)])
+	upsert = import_charges.upsert_charge_frame
+	written = []
+
+	def upsert_failing_on_charge_5(session, calendar, frame, days_threshold, incremental=False):
+		if 5 in list(frame['id']):
+			raise RuntimeError("connection lost")
+		written.extend(frame['id'])
+		return upsert(session, calendar, frame, days_threshold, incremental)
+
+	monkeypatch.setattr(import_charges, "upsert_charge_frame", upsert_failing_on_charge_5)
+	assert not stream_process_file_data(session, january, file, 45, chunk_size=2)
+	assert written == [1, 2, 3, 4]
+	checkpoint = get_import_checkpoint(session, january, file)
+	assert (checkpoint.last_row, checkpoint.completed) == (4, False)
+
+	def upsert_recording(session, calendar, frame, days_threshold, incremental=False):
+		written.extend(frame['id'])
+		return upsert(session, calendar, frame, days_threshold, incremental)
+
+	monkeypatch.setattr(import_charges, "upsert_charge_frame", upsert_recording)
+	written.clear()
+	assert stream_process_file_data(session, january, file, 45, chunk_size=2)
+	assert written == [5]
+	assert sorted(charge.id for charge in session.query(Charge)) == [1, 2, 3, 4, 5]
+
+	# a completed file is not read again
+	written.clear()
+	assert stream_process_file_data(session, january, file, 45, chunk_size=2)
+	assert written == []
+
+
+def test_streaming_import_resumes_inside_a_chunk(session, tmp_path, monkeypatch):
+	january, _ = add_calendars(session)
+	file = write_charges_csv(tmp_path, [f"{number},Open,10,A" for number in range(1, 6)])
+	checkpoint = get_import_checkpoint(session, january, file)
+	checkpoint.last_row = 3
+	session.commit()
+
+	upsert = import_charges.upsert_charge_frame
+	written = []
+
+	def upsert_recording(session, calendar, frame, days_threshold, incremental=False):
+		written.extend(frame['id'])
+		return upsert(session, calendar, frame, days_threshold, incremental)
+
+	monkeypatch.setattr(import_charges, "upsert_charge_frame", upsert_recording)
+	assert stream_process_file_data(session, january, file, 45, chunk_size=2)
+	assert written == [4, 5]
+	assert get_import_checkpoint(session, january, file).completed
@@ -0,0 +1,124 @@
+import datetime
+import os
+
+from data_import import import_related_data
+from data_import.import_related_data import (
+	store_csv_data_batch, import_combined_files_process, prepare_charge_tabs, write_charge_tabs, store_tab_rows,
+	find_csv_path
+)
+from data_import.models import Attachment, Calendar, Charge, Document
+
+
+def add_charge(session, charge=1):
+	day = datetime.date(2024, 1, 1)
+	session.add(Calendar(id=1, year=2024, month=1, start_date=day, end_date=day))
+	session.add(Charge(id=charge, calendar_id=1, pulled=True, imported=False))
+	session.commit()
+
+
+# a Document of the Charge with an Attachment related to it, like after get_attachments.relate_attachment
+def add_linked_attachment(session, charge=1):
+	document = Document(document_name="invoice.pdf", charge_number=charge)
+	session.add(document)
+	session.flush()
+	attachment = Attachment(
+		filename="invoice.pdf", link="link", downloaded=True, charge_number=charge, document_id=document.id
+	)
+	session.add(attachment)
+	session.commit()
+	return attachment
+
+
+def write_documents_csv(directory, charge=1):
+	tab_directory = os.path.join(directory, "Docs & Pics")
+	os.makedirs(tab_directory, exist_ok=True)
+	path = os.path.join(tab_directory, f"Docs & Pics_{charge}.csv")
+	with open(path, "w") as file:
+		file.write("Document Name\ninvoice.pdf\nphoto.jpg\n")
+	return {"Docs & Pics": path}
+
+
+def test_batch_reimport_of_charge_with_linked_attachment(session, tmp_path):
+	add_charge(session)
+	attachment = add_linked_attachment(session)
+	files = write_documents_csv(tmp_path)
+
+	assert store_csv_data_batch(session, str(tmp_path), [1], {1: files})
+	session.expire_all()
+	assert session.get(Charge, 1).imported
+	assert session.query(Document).filter_by(charge_number=1).count() == 2
+	assert session.get(Attachment, attachment.id).document_id is None
+
+
+def write_combined_documents_csv(directory, rows):
+	tab_directory = os.path.join(directory, "Docs & Pics")
+	os.makedirs(tab_directory, exist_ok=True)
+	with open(os.path.join(tab_directory, "Docs & Pics_combined_20240101_000000.csv"), "w") as file:
+		file.write("Document Name,Charge Number\n")
+		file.writelines(f"{name},{charge}\n" for name, charge in rows)
+
+
+def test_combined_import_of_charge_with_linked_attachment(session, tmp_path):
+	add_charge(session)
+	session.add(Charge(id=2, calendar_id=1, pulled=True, imported=False))
+	session.commit()
+	attachment = add_linked_attachment(session)
+	write_combined_documents_csv(tmp_path, [("invoice.pdf", 1), ("photo.jpg", 2)])
+
+	import_combined_files_process(session, str(tmp_path), group_size=1)
+	session.expire_all()
+	assert session.get(Charge, 1).imported and session.get(Charge, 2).imported
+	assert session.get(Attachment, attachment.id).document_id is None
+	assert os.path.exists(os.path.join(tmp_path, "imported", "Docs & Pics", "Docs & Pics_combined_20240101_000000.csv"))
+
+
+def test_combined_import_failure_only_rolls_back_its_group(session, tmp_path, monkeypatch):
+	add_charge(session)
+	session.add(Charge(id=2, calendar_id=1, pulled=True, imported=False))
+	session.commit()
+	write_combined_documents_csv(tmp_path, [("invoice.pdf", 1), ("photo.jpg", 2)])
+
+	replace = import_related_data.replace_related_rows
+
+	def fail_for_charge_2(session, model, charges, records):
+		if 2 in charges:
+			raise ValueError("bad rows")
+		replace(session, model, charges, records)
+
+	monkeypatch.setattr(import_related_data, "replace_related_rows", fail_for_charge_2)
+	import_combined_files_process(session, str(tmp_path), group_size=1)
+	session.expire_all()
+	assert session.get(Charge, 1).imported
+	assert not session.get(Charge, 2).imported
+	assert os.path.exists(os.path.join(tmp_path, "Docs & Pics", "Docs & Pics_combined_20240101_000000.csv"))
+
+
+def test_parallel_reimport_of_charge_with_linked_attachment(session, tmp_path):
+	add_charge(session)
+	attachment = add_linked_attachment(session)
+	files = write_documents_csv(tmp_path)
+
+	charge, tabs = prepare_charge_tabs(str(tmp_path), 1, files)
+	assert write_charge_tabs(session, charge, tabs)
+	session.expire_all()
+	assert session.get(Charge, 1).imported
+	assert session.query(Document).filter_by(charge_number=1).count() == 2
+	assert session.get(Attachment, attachment.id).document_id is None
+
+
+def test_dom_reimport_of_charge_with_linked_attachment(session):
+	add_charge(session)
+	attachment = add_linked_attachment(session)
+
+	assert store_tab_rows(session, 1, "Docs & Pics", ["Document Name"], [["invoice.pdf"], ["photo.jpg"]]) == 2
+	session.commit()
+	session.expire_all()
+	assert session.query(Document).filter_by(charge_number=1).count() == 2
+	assert session.get(Attachment, attachment.id).document_id is None
+
+
+def test_moved_manifest_file_falls_back_to_directory(tmp_path):
+	files = write_documents_csv(tmp_path)
+	recorded = {"Docs & Pics": str(tmp_path / "old location.csv")}
+	assert find_csv_path(str(tmp_path), "Docs & Pics", 1, recorded) == files["Docs & Pics"]
+	assert find_csv_path(str(tmp_path), "Docs & Pics", 2, {"Docs & Pics": str(tmp_path / "old location.csv")}) is None
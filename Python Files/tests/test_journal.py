@@ -0,0 +1,39 @@
+import datetime
+
+from data_import.journal import (
+	record_tab, record_tab_failure, get_scraped_tabs, get_abandoned_tabs, max_tab_attempts, tab_empty, tab_failed
+)
+from data_import.models import Calendar, Charge
+
+
+def add_charge(session, charge=1):
+	day = datetime.date(2024, 1, 1)
+	session.add(Calendar(id=1, year=2024, month=1, start_date=day, end_date=day))
+	session.add(Charge(id=charge, calendar_id=1, pulled=False, imported=False))
+	session.commit()
+
+
+def test_failed_tab_is_retried_until_out_of_attempts(session):
+	add_charge(session)
+
+	for attempt in range(1, max_tab_attempts):
+		entry = record_tab_failure(session, 1, "Disputes", "export button missing")
+		assert entry.status == tab_failed and entry.attempts == attempt
+		assert "Disputes" not in get_scraped_tabs(session, 1)
+		assert get_abandoned_tabs(session, 1) == {}
+
+	entry = record_tab_failure(session, 1, "Disputes", "export button missing")
+	assert entry.attempts == max_tab_attempts
+	assert "Disputes" in get_scraped_tabs(session, 1)
+	assert list(get_abandoned_tabs(session, 1)) == ["Disputes"]
+	assert get_abandoned_tabs(session, 1)["Disputes"].last_error == "export button missing"
+
+
+def test_finished_tab_resets_its_attempts(session):
+	add_charge(session)
+	record_tab_failure(session, 1, "Disputes", "timeout")
+
+	entry = record_tab(session, 1, "Disputes", tab_empty)
+	assert entry.attempts == 0 and entry.last_error is None
+	assert "Disputes" in get_scraped_tabs(session, 1)
+	assert get_abandoned_tabs(session, 1) == {}
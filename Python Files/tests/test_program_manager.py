@@ -0,0 +1,142 @@
+import datetime
+import os
+import queue
+import threading
+
+from sqlalchemy.orm import sessionmaker
+
+import program_manager
+from data_import.models import Attachment, Calendar, Charge, Document
+
+
+class FakeDriver:
+	quit_called = False
+
+	def quit(self):
+		self.quit_called = True
+
+
+# a scraped Charge with a Document, an Attachment related to it that is still to be downloaded and the Charge's
+# Docs & Pics file in directory. Returns the Attachment's id and the Charge's files
+def add_scraped_charge(session, directory, charge=1):
+	day = datetime.date(2024, 1, 1)
+	session.add(Calendar(id=1, year=2024, month=1, start_date=day, end_date=day))
+	session.add(Charge(id=charge, calendar_id=1, pulled=True, imported=False))
+	document = Document(document_name="invoice.pdf", charge_number=charge)
+	session.add(document)
+	session.flush()
+	attachment = Attachment(
+		filename="invoice.pdf", link="link", downloaded=False, charge_number=charge, document_id=document.id
+	)
+	session.add(attachment)
+	session.commit()
+
+	tab_directory = os.path.join(directory, "Docs & Pics")
+	os.makedirs(tab_directory, exist_ok=True)
+	path = os.path.join(tab_directory, f"Docs & Pics_{charge}.csv")
+	with open(path, "w") as file:
+		file.write("Document Name\ninvoice.pdf\nphoto.jpg\n")
+	return attachment.id, {"Docs & Pics": path}
+
+
+def drain(pipeline_queue):
+	items = []
+	while not pipeline_queue.empty():
+		items.append(pipeline_queue.get_nowait())
+	return items
+
+
+def test_import_stage_hands_imported_charge_to_attachments(engine, session, tmp_path, monkeypatch):
+	attachment_id, files = add_scraped_charge(session, str(tmp_path))
+	monkeypatch.setattr(program_manager, "downloads_dir", str(tmp_path))
+	monkeypatch.setattr(program_manager, "get_charge_files", lambda session, charge: files)
+
+	import_queue, attachment_queue = queue.Queue(), queue.Queue()
+	import_queue.put(1)
+	import_queue.put(None)
+	failed = []
+	program_manager.import_stage(sessionmaker(bind=engine), import_queue, attachment_queue, {"import": 0.0}, failed)
+
+	assert drain(attachment_queue) == [1, None]
+	assert failed == []
+	session.expire_all()
+	assert session.get(Charge, 1).imported
+	assert session.get(Attachment, attachment_id).document_id is None
+
+
+def test_import_stage_reports_failed_charge(engine, session, tmp_path, monkeypatch):
+	add_scraped_charge(session, str(tmp_path))
+
+	def broken_files(directory, charge, files=None):
+		raise ValueError("unreadable file")
+
+	monkeypatch.setattr(program_manager, "prepare_charge_tabs", broken_files)
+	import_queue, attachment_queue = queue.Queue(), queue.Queue()
+	import_queue.put(1)
+	import_queue.put(None)
+	failed = []
+	program_manager.import_stage(sessionmaker(bind=engine), import_queue, attachment_queue, {"import": 0.0}, failed)
+
+	assert drain(attachment_queue) == [None]
+	assert failed == [1]
+	session.expire_all()
+	assert not session.get(Charge, 1).imported
+
+
+def test_stages_shut_down_through_both_queues(engine, session, tmp_path, monkeypatch):
+	attachment_id, files = add_scraped_charge(session, str(tmp_path))
+	driver = FakeDriver()
+	fetched = []
+	monkeypatch.setattr(program_manager, "downloads_dir", str(tmp_path))
+	monkeypatch.setattr(program_manager, "get_charge_files", lambda session, charge: files)
+	monkeypatch.setattr(program_manager, "setup_driver", lambda **kwargs: driver)
+	monkeypatch.setattr(program_manager, "set_asset_blocking", lambda driver, blocked: None)
+	monkeypatch.setattr(program_manager, "login", lambda driver: None)
+
+	def fetch(session, driver, attachments, tabs):
+		for attachment in attachments:
+			fetched.append(attachment.id)
+			attachment.downloaded = True
+		session.commit()
+
+	monkeypatch.setattr(program_manager, "fetch_attachments_concurrently", fetch)
+
+	Session = sessionmaker(bind=engine)
+	import_queue, attachment_queue = queue.Queue(maxsize=1), queue.Queue(maxsize=1)
+	busy = {"import": 0.0, "attachments": 0.0}
+	stages = [
+		threading.Thread(target=program_manager.import_stage, args=(Session, import_queue, attachment_queue, busy, [])),
+		threading.Thread(target=program_manager.attachment_stage, args=(Session, attachment_queue, busy)),
+	]
+	for stage in stages:
+		stage.start()
+	import_queue.put(1)
+	import_queue.put(None)
+	for stage in stages:
+		stage.join(timeout=10)
+
+	assert not any(stage.is_alive() for stage in stages)
+	assert fetched == [attachment_id]
+	assert driver.quit_called
+
+
+def test_attachment_stage_skips_attachments_waiting_for_backoff(engine, session, tmp_path, monkeypatch):
+	attachment_id, _ = add_scraped_charge(session, str(tmp_path))
+	attachment = session.get(Attachment, attachment_id)
+	attachment.attempts = 1
+	attachment.next_attempt_at = datetime.datetime.now() + datetime.timedelta(hours=1)
+	session.commit()
+	fetched = []
+	monkeypatch.setattr(program_manager, "setup_driver", lambda **kwargs: FakeDriver())
+	monkeypatch.setattr(program_manager, "set_asset_blocking", lambda driver, blocked: None)
+	monkeypatch.setattr(program_manager, "login", lambda driver: None)
+	monkeypatch.setattr(
+		program_manager, "fetch_attachments_concurrently",
+		lambda session, driver, attachments, tabs: fetched.extend(attachments)
+	)
+
+	attachment_queue = queue.Queue()
+	attachment_queue.put(1)
+	attachment_queue.put(None)
+	program_manager.attachment_stage(sessionmaker(bind=engine), attachment_queue, {"attachments": 0.0})
+	assert fetched == []